@@ -25,6 +25,8 @@ const ChatInterface = () => {
   const [userInput, setUserInput] = useState("");
   const [messages, setMessages] = useState([]);
   const chatMessagesRef = useRef(null);
+  const socketRef = useRef(null); // authenticated chat socket, null until "ready"
+  const pendingRef = useRef({}); // correlation id -> id of the user message it answers
   const [selectedMember, setSelectedMember] = useState(null);
 
   // ===== UI state =====
@@ -105,6 +107,69 @@ const ChatInterface = () => {
     }
   }, [selectedAPI, apiKeys, availableProviders]); // keep in sync
 
+  // ===== Chat socket =====
+  // One socket per session: it authenticates once, carries the API keys, and
+  // the server saves every finished exchange. Plain HTTP is the fallback.
+  const apiKeysRef = useRef(apiKeys);
+  useEffect(() => {
+    const token = localStorage.getItem("accessToken");
+    if (!email || !token) return undefined;
+    const ws = new WebSocket("ws://localhost:8000/medlife/ws/chat");
+    ws.onopen = () => ws.send(JSON.stringify({ type: "auth", token, api_keys: apiKeysRef.current }));
+    ws.onmessage = (event) => handleSocketFrame(ws, JSON.parse(event.data));
+    ws.onclose = () => {
+      if (socketRef.current === ws) socketRef.current = null;
+      // Questions still in flight will not get an answer any more
+      Object.keys(pendingRef.current).forEach((id) =>
+        handleSocketFrame(ws, { type: "error", id, error: "Connection lost" })
+      );
+    };
+    return () => ws.close();
+  }, [email]);
+
+  useEffect(() => {
+    apiKeysRef.current = apiKeys;
+    if (socketRef.current) {
+      socketRef.current.send(JSON.stringify({ type: "keys", api_keys: apiKeys }));
+    }
+  }, [apiKeys]);
+
+  const handleSocketFrame = (ws, frame) => {
+    if (frame.type === "ready") {
+      socketRef.current = ws;
+      return;
+    }
+    const userMessageId = pendingRef.current[frame.id];
+    if (userMessageId === undefined) return;
+    const answerId = `answer-${frame.id}`;
+    if (frame.type === "chunk") {
+      setMessages((prev) =>
+        prev.map((m) =>
+          m.id === answerId
+            ? { ...m, text: (m.streaming ? m.text : "") + frame.delta.replace(/\n/g, "<br>"), streaming: true }
+            : m
+        )
+      );
+    } else if (frame.type === "done") {
+      delete pendingRef.current[frame.id];
+      // Swap in the saved copies, which carry the server's ids
+      const [question, answer] = frame.messages;
+      setMessages((prev) =>
+        prev.map((m) =>
+          m.id === userMessageId
+            ? { ...question, saved: true }
+            : m.id === answerId
+            ? { ...answer, saved: true }
+            : m
+        )
+      );
+    } else if (frame.type === "error") {
+      delete pendingRef.current[frame.id];
+      setMessages((prev) => prev.filter((m) => m.id !== answerId));
+      showBackendError(String(frame.error));
+    }
+  };
+
   // ===== Helpers =====
   const appendMessage = (sender, name, text) => {
     setMessages((prev) => [
@@ -118,6 +183,42 @@ const ChatInterface = () => {
     ]);
   };
 
+  const showBackendError = (errorData) => {
+    if (errorData.toLowerCase().includes("api key")) {
+      appendMessage("ai", "Medlife.ai", "Please provide a valid API key to continue.");
+      setShowApiKeyPopup(true);
+    } else if (errorData.toLowerCase().includes("quota")) {
+      appendMessage("ai", "Medlife.ai", "Your API key has exceeded its quota.");
+    } else {
+      appendMessage("ai", "Medlife.ai", `Error from backend: ${errorData}`);
+    }
+  };
+
+  const askOverSocket = (message) => {
+    const requestId = `${Date.now()}-${Math.random().toString(36).slice(2, 8)}`;
+    const userMessageId = Date.now();
+    pendingRef.current[requestId] = userMessageId;
+    setMessages((prev) => [
+      ...prev,
+      { sender: "user", name: "You", text: message.replace(/\n/g, "<br>"), id: userMessageId },
+      {
+        sender: "ai",
+        name: "Medlife.ai",
+        text: "Analyzing<span class='dot'>.</span><span class='dot'>.</span><span class='dot'>.</span>",
+        id: `answer-${requestId}`,
+      },
+    ]);
+    socketRef.current.send(
+      JSON.stringify({
+        type: "ask",
+        id: requestId,
+        member_index: selectedMember.memberIndex,
+        query: message,
+        provider: selectedAPI,
+      })
+    );
+  };
+
   // ===== Actions =====
   const handleSendMessage = async () => {
     const message = userInput.trim();
@@ -131,8 +232,13 @@ const ChatInterface = () => {
       return;
     }
 
-    appendMessage("user", "You", message);
     setUserInput("");
+    if (socketRef.current) {
+      askOverSocket(message);
+      return;
+    }
+
+    appendMessage("user", "You", message);
     setMessages((prev) => [
       ...prev,
       {
@@ -144,27 +250,29 @@ const ChatInterface = () => {
     ]);
 
     try {
-      const memberData = selectedMember ? JSON.stringify(selectedMember) : "";
-      const res = await fetch(
-        `http://localhost:8000/medlife/ask_ai/?query=${encodeURIComponent(
-          message
-        )}&api_key=${encodeURIComponent(apiKeys[selectedAPI])}&provider=${encodeURIComponent(
-          selectedAPI
-        )}&email=${encodeURIComponent(email)}&member_data=${encodeURIComponent(memberData)}`
-      );
+      // The server looks the member up by index; no profile or key in the URL
+      const res = await fetch("http://localhost:8000/medlife/ask_ai/", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+          email,
+          member_index: selectedMember.memberIndex,
+          query: message,
+          api_key: apiKeys[selectedAPI],
+          provider: selectedAPI,
+        }),
+      });
 
       if (!res.ok) {
-        const errorData = await res.text();
-        setMessages((prev) => prev.filter((m) => m.id !== loadingMessageId));
-
-        if (errorData.toLowerCase().includes("api key")) {
-          appendMessage("ai", "Medlife.ai", "Please provide a valid API key to continue.");
-          setShowApiKeyPopup(true);
-        } else if (errorData.toLowerCase().includes("quota")) {
-          appendMessage("ai", "Medlife.ai", "Your API key has exceeded its quota.");
-        } else {
-          appendMessage("ai", "Medlife.ai", `Error from backend: ${errorData}`);
+        const errorText = await res.text();
+        let errorData = errorText;
+        try {
+          errorData = JSON.parse(errorText).detail || errorText;
+        } catch (e) {
+          // plain-text error body
         }
+        setMessages((prev) => prev.filter((m) => m.id !== loadingMessageId));
+        showBackendError(errorData);
         return;
       }
 
@@ -183,15 +291,29 @@ const ChatInterface = () => {
       return;
     }
     try {
-      const url = `http://localhost:8000/medlife/saveChat/?email=${encodeURIComponent(
+      const url = `http://localhost:8000/medlife/appendChat/?email=${encodeURIComponent(
         email
       )}&member_name=${encodeURIComponent(`${selectedMember.firstName}_${selectedMember.lastName}`)}`;
+      // Only send what the server does not have yet; placeholders such as the
+      // "Analyzing..." bubble carry string ids and are never saved. Local ids
+      // only key the list: the server numbers saved messages itself, so a
+      // browser clock behind the server's cannot make it drop them.
+      const unsaved = messages.filter((m) => !m.saved && typeof m.id === "number");
+      if (!unsaved.length) {
+        alert("Chat saved to server successfully.");
+        return;
+      }
       const response = await fetch(url, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ chat: messages }),
+        body: JSON.stringify({ messages: unsaved, assign_ids: true }),
       });
       if (!response.ok) throw new Error("Failed to save chat data");
+      const saved = await response.json();
+      const savedCopies = new Map(unsaved.map((m, i) => [m.id, saved.messages[i]]));
+      setMessages((prev) =>
+        prev.map((m) => (!m.saved && savedCopies.has(m.id) ? { ...savedCopies.get(m.id), saved: true } : m))
+      );
       alert("Chat saved to server successfully.");
     } catch (err) {
       console.error("Error saving chat:", err);
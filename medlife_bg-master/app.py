@@ -6,7 +6,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 import json
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
 import random
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
@@ -14,10 +15,17 @@ from jose import JWTError, jwt
 from dotenv import load_dotenv
 import os
 import sqlite3
+import queue
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
-import requests
+import httpx
+import asyncio
+import time
+from collections import OrderedDict, deque
 import base64
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography   .hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import secrets
@@ -30,7 +38,7 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-from typing import Optional
+from typing import Optional, Dict, List
 from datetime import datetime, timedelta
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -70,10 +78,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+#<<<<<<<<<<<<<<<<<DB EXECUTOR>>>>>>>>>>>>>>>>>>
+
+# sqlite3 calls block, so endpoints that touch the database run their body on
+# a dedicated thread pool (sized like the connection pool) rather than on the
+# event loop, where they would stall in-flight chat requests.
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", os.getenv("DB_POOL_SIZE", "8")))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="medlife-db")
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+def runs_in_db_executor(func):
+    """Turn a blocking endpoint into a coroutine that runs it on db_executor"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    return wrapper
+
+@app.on_event("shutdown")
+def shutdown_db_executor():
+    db_executor.shutdown(wait=True)
+
 from fastapi import Query
 
 @app.get("/api/get-username")
-async def get_username(email: str = Query(...)):
+@runs_in_db_executor
+def get_username(email: str = Query(...)):
     conn = get_db_connection()
     try:
         cursor = conn.execute("SELECT username FROM users WHERE email = ?", (email,))
@@ -86,26 +118,118 @@ async def get_username(email: str = Query(...)):
         conn.close()
 
 @app.get("/api/get-user-gender")
-async def get_user_gender(email: str = Query(...)):
-    conn = get_db_connection()
-    try:
-        cursor = conn.execute("SELECT member1_gender FROM family_members WHERE email = ?", (email,))
-        row = cursor.fetchone()
-        if row and row["member1_gender"]:
-            return {"gender": row["member1_gender"]}
-        else:
-            return {"gender": None}
-    finally:
-        conn.close()
+@runs_in_db_executor
+def get_user_gender(email: str = Query(...)):
+    member = find_profile_member(get_member_profile(email), member_index=1)
+    if member and member["gender"]:
+        return {"gender": member["gender"]}
+    else:
+        return {"gender": None}
 
 # ---------- USER AUTH SETUP ----------
 DATABASE_URL = "users.db"
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Pooled connections. WAL lets readers run alongside the single writer and
+# busy_timeout makes writers wait instead of failing with "database is
+# locked". Long-lived connections also keep sqlite3's per-connection
+# prepared-statement cache warm.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+class PooledConnection:
+    """Behaves like a sqlite3.Connection; close() hands it back to the pool"""
+
+    def __init__(self, pool, conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+class SQLiteConnectionPool:
+    def __init__(self, database: str, size: int):
+        self.database = database
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.database,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,  # connections move between the loop and threadpool
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        try:
+            conn = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            conn = self._connect()
+            reused = False
+        with self._lock:
+            if reused:
+                self.reused += 1
+            else:
+                self.created += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return PooledConnection(self, conn)
+
+    def release(self, conn: sqlite3.Connection):
+        with self._lock:
+            self.in_use -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()  # never hand out a connection mid-transaction
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+            with self._lock:
+                self.discarded += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "idle": self._idle.qsize(),
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "created": self.created,
+                "reused": self.reused,
+                "discarded": self.discarded,
+            }
+
+db_pool = SQLiteConnectionPool(DATABASE_URL, DB_POOL_SIZE)
 
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE_URL)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return db_pool.acquire()
+
+@app.get("/medlife/metrics/db-pool")
+async def db_pool_metrics():
+    return db_pool.stats()
 
 def init_user_db():
     conn = get_db_connection()
@@ -168,11 +292,358 @@ def init_user_db():
         member4_tokens INTEGER DEFAULT 0
     )
     """)
+    # Row-per-member store. family_members stays as the per-account row; its
+    # memberN_* columns are only read by the migration below.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL,
+            member_index INTEGER NOT NULL,
+            first_name TEXT NOT NULL,
+            last_name TEXT,
+            dob TEXT,
+            race TEXT,
+            gender TEXT,
+            height TEXT,
+            weight TEXT,
+            a1c TEXT,
+            blood_pressure TEXT,
+            medicine TEXT,
+            tokens INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_members_email ON members (email)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_members_name ON members (email, first_name, last_name)")
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(family_members)")]
+    if "migrated" not in columns:
+        conn.execute("ALTER TABLE family_members ADD COLUMN migrated INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_family_members_migrated ON family_members (migrated)")
+    # Exact-match cache of AI answers, see get_cached_answer()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_answer_cache (
+            cache_key TEXT PRIMARY KEY,
+            email TEXT,
+            member_name TEXT,
+            provider TEXT NOT NULL,
+            model TEXT,
+            answer TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_answer_cache_member ON ai_answer_cache (email, member_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_answer_cache_access ON ai_answer_cache (last_access)")
+    # Full-text index of saved chat messages, see search_chat_messages()
+    global CHAT_SEARCH_AVAILABLE
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS chat_search USING fts5(
+                text, scope,
+                email UNINDEXED, member_name UNINDEXED, message_id UNINDEXED, sender UNINDEXED,
+                tokenize = 'porter unicode61'
+            )
+        """)
+        CHAT_SEARCH_AVAILABLE = True
+    except sqlite3.OperationalError as e:
+        logging.warning(f"SQLite has no FTS5, chat search disabled: {e}")
+        CHAT_SEARCH_AVAILABLE = False
+    # Durable queue behind the /medlife/jobs/ endpoints, see run_job_worker()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_jobs (
+            id TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            status TEXT NOT NULL,
+            request TEXT NOT NULL,
+            api_key TEXT,
+            result TEXT,
+            error TEXT,
+            status_code INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            deadline_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_jobs_status ON ai_jobs (status, created_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_search_state (
+            email TEXT NOT NULL,
+            member_name TEXT NOT NULL,
+            PRIMARY KEY (email, member_name)
+        )
+    """)
     conn.commit()
     conn.close()
 
 init_user_db()
 
+#<<<<<<<<<<<<<<<<<MEMBER STORE>>>>>>>>>>>>>>>>>>>>
+
+# API field name -> members column
+MEMBER_COLUMNS = {
+    "firstName": "first_name",
+    "lastName": "last_name",
+    "dob": "dob",
+    "race": "race",
+    "gender": "gender",
+    "height": "height",
+    "weight": "weight",
+    "a1c": "a1c",
+    "bloodPressure": "blood_pressure",
+    "medicine": "medicine",
+    "tokens": "tokens",
+}
+MAX_MEMBERS = 4
+MEMBER_MIGRATION_BATCH = int(os.getenv("MEMBER_MIGRATION_BATCH", "200"))
+
+member_migration_state = {"complete": False, "migrated_accounts": 0, "migrated_members": 0, "batches": 0}
+
+def member_to_dict(row) -> dict:
+    member = {field: row[column] for field, column in MEMBER_COLUMNS.items()}
+    member["tokens"] = member["tokens"] or 0
+    return member
+
+def member_values(data) -> tuple:
+    return tuple(getattr(data, field) for field in MEMBER_COLUMNS)
+
+def lowest_free_member_index(conn, email: str) -> Optional[int]:
+    taken = {row[0] for row in conn.execute("SELECT member_index FROM members WHERE email = ?", (email,))}
+    return next((i for i in range(1, MAX_MEMBERS + 1) if i not in taken), None)
+
+def renumber_duplicate_members(conn):
+    """Move members that share a slot with an older member into a free slot,
+    so the unique (email, member_index) index can be built"""
+    duplicates = conn.execute(
+        """
+        SELECT m.id, m.email FROM members m
+        WHERE EXISTS (
+            SELECT 1 FROM members o
+            WHERE o.email = m.email AND o.member_index = m.member_index AND o.id < m.id
+        )
+        ORDER BY m.id
+        """
+    ).fetchall()
+    for row in duplicates:
+        free = lowest_free_member_index(conn, row["email"])
+        if free is None:
+            # Every slot is taken; park it after them rather than lose it
+            free = conn.execute("SELECT MAX(member_index) + 1 FROM members WHERE email = ?", (row["email"],)).fetchone()[0]
+        conn.execute("UPDATE members SET member_index = ? WHERE id = ?", (free, row["id"]))
+        logging.warning(f"Moved duplicate member {row['id']} of {row['email']} to slot {free}")
+
+def init_member_slots():
+    conn = get_db_connection()
+    try:
+        renumber_duplicate_members(conn)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_members_slot ON members (email, member_index)")
+        conn.commit()
+    finally:
+        conn.close()
+
+init_member_slots()
+
+def migrate_account_members(conn, family_row) -> int:
+    """
+    Copy one legacy family_members row into members. The migrated flag is
+    flipped first, in the same transaction, so an account is only ever copied
+    once even when the background job and a request race for it.
+    """
+    claimed = conn.execute(
+        "UPDATE family_members SET migrated = 1 WHERE id = ? AND migrated = 0",
+        (family_row["id"],)
+    ).rowcount
+    if not claimed:
+        return 0
+    copied = 0
+    for i in range(1, MAX_MEMBERS + 1):
+        prefix = f"member{i}_"
+        if not family_row[prefix + "firstName"]:
+            continue
+        copied += 1
+        # Keep the legacy slot number; clients address members by it
+        conn.execute(
+            """
+            INSERT INTO members (email, member_index, first_name, last_name, dob, race, gender,
+                                 height, weight, a1c, blood_pressure, medicine, tokens)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (family_row["email"], i, *(family_row[prefix + field] for field in MEMBER_COLUMNS if field != "tokens"),
+             family_row[prefix + "tokens"] or 0)
+        )
+    member_migration_state["migrated_accounts"] += 1
+    member_migration_state["migrated_members"] += copied
+    return copied
+
+def ensure_members_migrated(conn, email: str):
+    """Migrate one account on demand while the background migration is still running"""
+    if member_migration_state["complete"]:
+        return
+    row = conn.execute("SELECT * FROM family_members WHERE email = ? AND migrated = 0", (email,)).fetchone()
+    if row is not None:
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        migrate_account_members(conn, row)
+        conn.commit()
+
+def migrate_member_batch(batch_size: int = MEMBER_MIGRATION_BATCH) -> int:
+    """Migrate the next batch of legacy rows; returns how many rows were claimed"""
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT * FROM family_members WHERE migrated = 0 ORDER BY id LIMIT ?",
+            (batch_size,)
+        ).fetchall()
+        for row in rows:
+            migrate_account_members(conn, row)
+        conn.commit()
+        member_migration_state["batches"] += 1
+        if not rows:
+            member_migration_state["complete"] = True
+        return len(rows)
+    finally:
+        conn.close()
+
+async def run_member_migration():
+    # Small batches with a pause in between keep the migration online: request
+    # traffic gets the write lock between batches.
+    try:
+        while await run_db(migrate_member_batch):
+            await asyncio.sleep(0.05)
+        logging.info("members migration complete")
+    except sqlite3.Error as e:
+        logging.error(f"members migration paused, will resume on next start: {e}")
+
+@app.on_event("startup")
+async def start_member_migration():
+    asyncio.create_task(run_member_migration())
+
+def fetch_members(conn, email: str):
+    ensure_members_migrated(conn, email)
+    return conn.execute(
+        "SELECT * FROM members WHERE email = ? ORDER BY member_index",
+        (email,)
+    ).fetchall()
+
+def fetch_member(conn, email: str, member_index: int):
+    ensure_members_migrated(conn, email)
+    return conn.execute(
+        "SELECT * FROM members WHERE email = ? AND member_index = ?",
+        (email, member_index)
+    ).fetchone()
+
+def account_exists(conn, email: str) -> bool:
+    return conn.execute("SELECT 1 FROM family_members WHERE email = ?", (email,)).fetchone() is not None
+
+#<<<<<<<<<<<<<<<<<MEMBER PROFILE CACHE>>>>>>>>>>>>>>>>>>>>
+
+# Parsed member lists keyed by email, shared by getmember, member-details,
+# tokensCount and get-user-gender. Every write path invalidates the account.
+MEMBER_CACHE_MAX_ENTRIES = int(os.getenv("MEMBER_CACHE_MAX_ENTRIES", "2048"))
+MEMBER_CACHE_TTL_SECONDS = float(os.getenv("MEMBER_CACHE_TTL_SECONDS", "300"))
+
+class MemberProfileCache:
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped on every invalidation; a load that raced with a write is not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, email: str, loader) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self._entries.move_to_end(email)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+        profile = loader(email)
+        with self._lock:
+            if generation == self._generation:
+                self._entries[email] = (profile, now)
+                self._entries.move_to_end(email)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return profile
+
+    def invalidate(self, email: str):
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(email, None) is not None:
+                self.invalidations += 1
+
+    def set_tokens(self, email: str, first_name: str, tokens: int):
+        """Patch a token count in place so each question does not evict the profile"""
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.get(email)
+            if entry is None:
+                return
+            for member in entry[0]["members"]:
+                if member["firstName"] == first_name:
+                    member["tokens"] = tokens
+                    break
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+member_profile_cache = MemberProfileCache(MEMBER_CACHE_MAX_ENTRIES, MEMBER_CACHE_TTL_SECONDS)
+
+def load_member_profile(email: str) -> dict:
+    conn = get_db_connection()
+    try:
+        exists = account_exists(conn, email)
+        members = [
+            {"id": row["id"], "memberIndex": row["member_index"], **member_to_dict(row)}
+            for row in fetch_members(conn, email)
+        ]
+    finally:
+        conn.close()
+    return {"exists": exists, "members": members}
+
+def get_member_profile(email: str) -> dict:
+    return member_profile_cache.get(email, load_member_profile)
+
+def find_profile_member(profile: dict, member_index: Optional[int] = None, first_name: Optional[str] = None):
+    for member in profile["members"]:
+        if member_index is not None and member["memberIndex"] == member_index:
+            return member
+        if first_name is not None and member["firstName"] == first_name:
+            return member
+    return None
+
+@app.get("/medlife/metrics/member-cache")
+async def member_cache_metrics():
+    return member_profile_cache.stats()
+
+@app.get("/medlife/metrics/members-migration")
+@runs_in_db_executor
+def member_migration_metrics():
+    conn = get_db_connection()
+    try:
+        remaining = conn.execute("SELECT COUNT(*) FROM family_members WHERE migrated = 0").fetchone()[0]
+    finally:
+        conn.close()
+    return {**member_migration_state, "remaining_accounts": remaining}
+
 # DATA MODELS
 
 # ---------------- AUTH ENDPOINTS -----------------
@@ -185,23 +656,102 @@ class UserLogin(BaseModel):
     login: str  # username or email
     password: str
 
-@app.post("/token")
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+#<<<<<<<<<<<<<<<<<PASSWORD HASHING>>>>>>>>>>>>>>>>>>
+
+# bcrypt is slow on purpose, so hashing and verifying never run on the event
+# loop or the DB executor. They get a small pool of their own: a login burst
+# queues there, up to PASSWORD_HASH_MAX_PENDING, while chat requests keep
+# going. With PASSWORD_REHASH_ON_LOGIN a successful login re-hashes a
+# password whose stored work factor differs from BCRYPT_ROUNDS.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_REHASH_ON_LOGIN = os.getenv("PASSWORD_REHASH_ON_LOGIN", "false").lower() == "true"
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="medlife-bcrypt")
+password_stats = {"pending": 0, "hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0, "seconds": 0.0}
+
+async def run_password_work(func, *args):
+    if password_stats["pending"] >= PASSWORD_HASH_MAX_PENDING:
+        password_stats["rejected"] += 1
+        raise HTTPException(status_code=503, detail="Too many sign-in attempts, please try again shortly",
+                            headers={"Retry-After": "1"})
+    password_stats["pending"] += 1
+    started = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, functools.partial(func, *args))
+    finally:
+        password_stats["pending"] -= 1
+        password_stats["seconds"] += time.perf_counter() - started
+
+async def hash_password(password: str) -> str:
+    password_hash = await run_password_work(pwd_context.hash, password)
+    password_stats["hashed"] += 1
+    return password_hash
+
+async def verify_password(password: str, password_hash: str):
+    """(matches, replacement hash or None)"""
+    if PASSWORD_REHASH_ON_LOGIN:
+        result = await run_password_work(pwd_context.verify_and_update, password, password_hash)
+    else:
+        result = await run_password_work(pwd_context.verify, password, password_hash), None
+    password_stats["verified"] += 1
+    return result
+
+def store_password_hash(email: str, password_hash: str):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT email, password_hash FROM users WHERE email = ? OR username = ?",
-        (form_data.username, form_data.username)
-    )
-    row = cursor.fetchone()
-    if row is None:
+    try:
+        conn.execute("UPDATE users SET password_hash = ? WHERE email = ?", (password_hash, email))
+        conn.commit()
+    finally:
         conn.close()
+
+async def authenticate_user(login: str, password: str) -> str:
+    """Email of the account `login` names if `password` matches, else 401"""
+    row = await run_db(fetch_login_row, login)
+    if row is None:
         raise HTTPException(status_code=401, detail="Incorrect email/username or password")
     email, password_hash = row
-    if not pwd_context.verify(form_data.password, password_hash):
-        conn.close()
+    matches, new_hash = await verify_password(password, password_hash)
+    if not matches:
         raise HTTPException(status_code=401, detail="Incorrect email/username or password")
-    conn.close()
+    if new_hash is not None:
+        try:
+            await run_db(store_password_hash, email, new_hash)
+            password_stats["rehashed"] += 1
+        except sqlite3.Error as e:
+            # The old hash still works; try again on the next login
+            logging.error(f"Could not store re-hashed password for {email}: {e}")
+    return email
+
+@app.on_event("shutdown")
+def shutdown_password_executor():
+    password_executor.shutdown(wait=True)
+
+@app.get("/medlife/metrics/password-hashing")
+async def password_hashing_metrics():
+    return {
+        "workers": PASSWORD_HASH_WORKERS,
+        "bcrypt_rounds": BCRYPT_ROUNDS,
+        "rehash_on_login": PASSWORD_REHASH_ON_LOGIN,
+        **password_stats,
+    }
+
+def fetch_login_row(login: str):
+    conn = get_db_connection()
+    try:
+        return conn.execute(
+            "SELECT email, password_hash FROM users WHERE email = ? OR username = ?",
+            (login, login)
+        ).fetchone()
+    finally:
+        conn.close()
+
+@app.post("/token")
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    email = await authenticate_user(form_data.username, form_data.password)
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -210,22 +760,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer", "email": email}
 
 @app.post("/signin")
-def login(user: UserLogin):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT email, password_hash FROM users WHERE email = ? OR username = ?",
-        (user.login, user.login)
-    )
-    row = cursor.fetchone()
-    if row is None:
-        conn.close()
-        raise HTTPException(status_code=401, detail="Incorrect email/username or password")
-    email, password_hash = row
-    if not pwd_context.verify(user.password, password_hash):
-        conn.close()
-        raise HTTPException(status_code=401, detail="Incorrect email/username or password")
-    conn.close()
+async def login(user: UserLogin):
+    email = await authenticate_user(user.login, user.password)
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -234,7 +770,7 @@ def login(user: UserLogin):
     return {"message": "Login successful", "email": email, "access_token": access_token}
 
 @app.post("/signup")
-def signup(user: UserSignup):
+async def signup(user: UserSignup):
     logging.debug(f"Signup request received: {user}")
     
     # Validate email format
@@ -255,18 +791,34 @@ def signup(user: UserSignup):
     if not re.search(r'[!@#$%^&*()_+\-=\[\]{};\':"\\|,.<>\/?]', password):
         raise HTTPException(status_code=400, detail="Password must contain at least one special character")
     
+    # Check before hashing so a taken email costs no bcrypt work
+    if await run_db(email_registered, user.email):
+        logging.warning(f"Signup attempt with existing email: {user.email}")
+        raise HTTPException(status_code=409, detail="Email already registered")
+    
+    password_hash = await hash_password(user.password)
+    await run_db(create_user, user, password_hash)
+    return {"message": "User registered successfully", "email": user.email}
+
+def email_registered(email: str) -> bool:
+    conn = get_db_connection()
+    try:
+        return conn.execute("SELECT 1 FROM users WHERE email = ?", (email,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def create_user(user: UserSignup, password_hash: str):
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Check if user already exists
+    # A concurrent signup may have taken the email while we were hashing
     cursor.execute("SELECT * FROM users WHERE email = ?", (user.email,))
     user_exists = cursor.fetchone()
     if user_exists:
+        conn.close()
         logging.warning(f"Signup attempt with existing email: {user.email}")
         raise HTTPException(status_code=409, detail="Email already registered")
     
-    password_hash = pwd_context.hash(user.password)
-    
     try:
         # Insert user
         cursor.execute(
@@ -282,11 +834,12 @@ def signup(user: UserSignup):
         
         if not family_exists:
             cursor.execute(
-                "INSERT INTO family_members (email) VALUES (?)",
+                "INSERT INTO family_members (email, migrated) VALUES (?, 1)",
                 (user.email,)
             )
         
         conn.commit()
+        member_profile_cache.invalidate(user.email)
         logging.info(f"User registered successfully: {user.email}")
         
     except sqlite3.Error as e:
@@ -294,8 +847,6 @@ def signup(user: UserSignup):
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
-    
-    return {"message": "User registered successfully", "email": user.email}
 
 class Data(BaseModel):
     firstName: str
@@ -333,27 +884,44 @@ def save_family_data(data):
 # Multi-provider API support functions
 def get_provider_config(provider: str):
     """Get configuration for different AI providers"""
+    # context_tokens is the prompt budget per model, including the conversation context
     configs = {
         "openai": {
             "name": "OpenAI",
             "base_url": "https://api.openai.com/v1",
-            "models": ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo-preview"]
+            "models": ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo-preview"],
+            "rpm": 500,
+            "tpm": 200000,
+            "max_output_tokens": 1000,
+            "context_tokens": {"gpt-3.5-turbo": 3000, "gpt-4": 3000, "gpt-4-turbo-preview": 6000}
         },
         "gemini": {
             "name": "Google Gemini",
             "base_url": "https://generativelanguage.googleapis.com/v1beta",
-            "models": ["gemini-2.0-flash", "gemini-2.0", "gemini-pro"]
+            "models": ["gemini-2.0-flash", "gemini-2.0", "gemini-pro"],
+            "rpm": 15,
+            "tpm": 1000000,
+            "max_output_tokens": 1000,
+            "context_tokens": {"gemini-2.0-flash": 8000, "gemini-2.0": 8000, "gemini-pro": 4000}
         },
         "mistral": {
             "name": "Mistral AI",
             "base_url": "https://api.mistral.ai/v1",
-            "models": ["mistral-small-latest", "mistral-large-latest", "open-mistral-7b"]
+            "models": ["mistral-small-latest", "mistral-large-latest", "open-mistral-7b"],
+            "rpm": 60,
+            "tpm": 500000,
+            "max_output_tokens": 1000,
+            "context_tokens": {"mistral-small-latest": 4000, "mistral-large-latest": 6000, "open-mistral-7b": 3000}
         },
         # Claude ordered with the lowest-cost first to maximize “free” mileage
         "claude": {
             "name": "Anthropic Claude",
             "base_url": "https://api.anthropic.com/v1",
-            "models": ["claude-3-haiku-20240307", "claude-3-5-sonnet-latest", "claude-3-opus-20240229"]
+            "models": ["claude-3-haiku-20240307", "claude-3-5-sonnet-latest", "claude-3-opus-20240229"],
+            "rpm": 50,
+            "tpm": 50000,
+            "max_output_tokens": 256,
+            "context_tokens": {"claude-3-haiku-20240307": 3000, "claude-3-5-sonnet-latest": 4000, "claude-3-opus-20240229": 4000}
         },
     }
     return configs.get(provider, configs["openai"])
@@ -377,130 +945,633 @@ def decrypt_api_key(encrypted_key: str, email: str) -> str:
     except:
         return encrypted_key  # Fallback for legacy keys
 
-def ask_openai(question, api_key, provider="openai", model=None):
-    """OpenAI API integration"""
-    if not api_key:
-        raise ValueError("OpenAI API key is required")
-    
-    client = OpenAI(api_key=api_key)
-    
-    if not model:
-        model = "gpt-3.5-turbo"
-    
-    messages = [
-        {"role": "system", "content": "You are a helpful healthcare AI assistant. Provide accurate, helpful medical information while reminding users to consult healthcare professionals for medical advice."},
-        {"role": "user", "content": question}
-    ]
-    
-    try:
-        completion = client.chat.completions.create(
-            messages=messages,
-            model=model,
-            max_tokens=1000,
-            temperature=0.7
+#<<<<<<<<<<<<<<<<<PROVIDER HTTP CLIENTS>>>>>>>>>>>>>>>>>>
+
+# One long-lived pooled client per provider host, so concurrent chats share
+# warm keep-alive connections instead of blocking the event loop.
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", "30"))
+PROVIDER_MAX_CONNECTIONS = int(os.getenv("PROVIDER_MAX_CONNECTIONS", "100"))
+PROVIDER_MAX_KEEPALIVE = int(os.getenv("PROVIDER_MAX_KEEPALIVE", "20"))
+PROVIDER_KEEPALIVE_EXPIRY = float(os.getenv("PROVIDER_KEEPALIVE_EXPIRY", "60"))
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx when installed)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_provider_http_clients: Dict[str, httpx.AsyncClient] = {}
+
+def get_provider_http_client(provider: str) -> httpx.AsyncClient:
+    """Return the shared async HTTP client for the provider's API host"""
+    host = httpx.URL(get_provider_config(provider)["base_url"]).host
+    client = _provider_http_clients.get(host)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(PROVIDER_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=PROVIDER_MAX_CONNECTIONS,
+                max_keepalive_connections=PROVIDER_MAX_KEEPALIVE,
+                keepalive_expiry=PROVIDER_KEEPALIVE_EXPIRY,
+            ),
         )
-        return completion.choices[0].message.content
-    except Exception as e:
-        raise ValueError(f"OpenAI API error: {str(e)}")
+        _provider_http_clients[host] = client
+    return client
 
-def ask_gemini(question, api_key, model="gemini-2.0-flash"):
-    "Google Gemini API integration with enhanced error handling"
-    if not api_key:
-        raise ValueError("Google Gemini API key is required")
-    
-    import socket
-    import time
-    
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent"
-    headers = {
-        "Content-Type": "application/json",
-        "X-goog-api-key": api_key
-    }
-    payload = {
-        "contents": [{
-            "parts": [{
-                "text": f"You are a helpful healthcare AI assistant. Provide accurate, helpful medical information while reminding users to consult healthcare professionals for medical advice.\n\nQuestion: {question}"
-            }]
-        }],
-        "generationConfig": {
-            "temperature": 0.7,
-            "topP": 0.8,
-            "maxOutputTokens": 1000
+@app.on_event("shutdown")
+async def close_provider_http_clients():
+    for client in list(_provider_http_clients.values()):
+        await client.aclose()
+    _provider_http_clients.clear()
+
+#<<<<<<<<<<<<<<<<<PROVIDER CLIENT REGISTRY>>>>>>>>>>>>>>>>>>
+
+CLIENT_REGISTRY_MAX_SIZE = int(os.getenv("CLIENT_REGISTRY_MAX_SIZE", "256"))
+CLIENT_REGISTRY_IDLE_SECONDS = float(os.getenv("CLIENT_REGISTRY_IDLE_SECONDS", "900"))
+
+class ProviderClientRegistry:
+    """
+    Bounded LRU of SDK client objects keyed by provider and a hash of the API
+    key, so the raw key is never held as a dict key. Entries idle longer than
+    `idle_seconds` are dropped. The clients share the per-host HTTP pool, so
+    evicting one never closes connections another user is relying on.
+    """
+
+    def __init__(self, max_size: int, idle_seconds: float):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self._clients: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(provider: str, api_key: str) -> str:
+        return f"{provider}:{hashlib.sha256(api_key.encode()).hexdigest()}"
+
+    def _evict_idle(self, now: float):
+        while self._clients:
+            key, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self._clients[key]
+            self.evictions += 1
+
+    def get(self, provider: str, api_key: str, factory):
+        now = time.monotonic()
+        self._evict_idle(now)
+        key = self._key(provider, api_key)
+        entry = self._clients.get(key)
+        if entry is not None:
+            self.hits += 1
+            client = entry[0]
+        else:
+            self.misses += 1
+            client = factory()
+        self._clients[key] = (client, now)
+        self._clients.move_to_end(key)
+        while len(self._clients) > self.max_size:
+            self._clients.popitem(last=False)
+            self.evictions += 1
+        return client
+
+    def items(self):
+        return [(key, entry[0]) for key, entry in self._clients.items()]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._clients),
+            "max_size": self.max_size,
+            "idle_seconds": self.idle_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
         }
-    }
-    
-    # Retry mechanism with exponential backoff
-    max_retries = 3
-    retry_delay = 1
-    
-    for attempt in range(max_retries):
+
+provider_client_registry = ProviderClientRegistry(CLIENT_REGISTRY_MAX_SIZE, CLIENT_REGISTRY_IDLE_SECONDS)
+
+def get_openai_client(api_key: str) -> AsyncOpenAI:
+    return provider_client_registry.get(
+        "openai",
+        api_key,
+        lambda: AsyncOpenAI(api_key=api_key, http_client=get_provider_http_client("openai"))
+    )
+
+@app.get("/medlife/metrics/clients")
+async def provider_client_metrics():
+    return provider_client_registry.stats()
+
+#<<<<<<<<<<<<<<<<<PROVIDER ERRORS>>>>>>>>>>>>>>>>>>
+
+class ProviderError(Exception):
+    """A provider call failed. `status_code` is what ask_ai answers with and
+    `trips_breaker` marks failures that say the provider itself is unhealthy."""
+    status_code = 502
+    trips_breaker = False
+
+    def __init__(self, provider: str, message: str):
+        super().__init__(message)
+        self.provider = provider
+
+class ProviderAuthError(ProviderError):
+    status_code = 401
+
+class ProviderRateLimitError(ProviderError):
+    status_code = 429
+
+class ProviderCreditsError(ProviderError):
+    status_code = 402
+
+class ProviderRequestError(ProviderError):
+    status_code = 400
+
+class ProviderUnavailableError(ProviderError):
+    status_code = 503
+    trips_breaker = True
+
+class CircuitOpenError(ProviderUnavailableError):
+    # Raised without calling the provider, so it must not feed the breaker again
+    trips_breaker = False
+
+#<<<<<<<<<<<<<<<<<PROVIDER RATE LIMITS>>>>>>>>>>>>>>>>>>
+
+# Requests wait here, first come first served, until the provider's RPM and
+# TPM budgets for that API key allow them, instead of spending a round trip
+# to collect a 429. Limits come from get_provider_config and can be
+# overridden per provider, e.g. GEMINI_RPM / GEMINI_TPM.
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "10"))
+
+class RateLimitTimeout(ProviderRateLimitError):
+    """Raised when a request would wait longer than the allowed queue time"""
+
+class TokenBucket:
+    def __init__(self, capacity: float, per_seconds: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay_for(self, amount: float, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+    def is_full(self, now: float) -> bool:
+        self.delay_for(0, now)
+        return self.tokens >= self.capacity
+
+class ProviderRateLimiter:
+    def __init__(self, provider: str, rpm: float, tpm: float):
+        self.provider = provider
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        # asyncio.Lock wakes waiters in arrival order, which gives the fair queue
+        self._turn = asyncio.Lock()
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def _wait_turn(self, token_cost: float):
+        async with self._turn:
+            while True:
+                now = time.monotonic()
+                delay = max(self.requests.delay_for(1, now), self.tokens.delay_for(token_cost, now))
+                if delay <= 0:
+                    self.requests.consume(1)
+                    self.tokens.consume(token_cost)
+                    return
+                await asyncio.sleep(delay)
+
+    async def acquire(self, token_cost: float, max_wait: Optional[float] = None):
+        if max_wait is None:
+            max_wait = RATE_LIMIT_MAX_WAIT_SECONDS
+        started = time.monotonic()
+        self.waiting += 1
         try:
-            # Test DNS resolution first
-            try:
-                socket.gethostbyname('generativelanguage.googleapis.com')
-            except socket.gaierror as dns_error:
-                logging.error(f"DNS resolution failed for generativelanguage.googleapis.com: {dns_error}")
-                return f"DNS resolution failed. Please check your internet connection or DNS settings. Error: {str(dns_error)}"
-            
-            response = requests.post(
-                url,
-                json=payload,
-                headers=headers,
-                timeout=30
+            await asyncio.wait_for(self._wait_turn(token_cost), timeout=max_wait)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise RateLimitTimeout(
+                self.provider,
+                f"{get_provider_config(self.provider)['name']} rate limit reached. Please try again later."
             )
-            response.raise_for_status()
-            data = response.json()
-            
-            if "candidates" in data and data["candidates"]:
-                return data["candidates"][0]["content"]["parts"][0]["text"]
-            else:
-                return "No response received from the AI service."
-                
-        except requests.exceptions.ConnectionError as e:
-            if "NameResolutionError" in str(e) or "getaddrinfo failed" in str(e):
-                logging.error(f"DNS resolution error on attempt {attempt + 1}: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay * (2 ** attempt))
-                    continue
-                return "DNS resolution failed. Please check your DNS settings or internet connection."
-            else:
-                logging.error(f"Connection error: {e}")
-                return "Unable to connect to the AI service. Please check your internet connection."
-                
-        except requests.exceptions.Timeout:
-            logging.error(f"Request timeout on attempt {attempt + 1}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay * (2 ** attempt))
-                continue
-            return "Request timeout. The AI service is taking longer than expected to respond."
-            
-        except requests.exceptions.HTTPError as e:
-            response = e.response  # Get response from exception
-            if response and response.status_code == 429:
-                return "API rate limit exceeded. Please try again later."
-            elif response and response.status_code == 401:
-                return "Invalid API key. Please check your Google Gemini API key."
-            elif response and response.status_code == 500:
-                return "Google Gemini service is temporarily unavailable. Please try again later."
-            else:
-                logging.error(f"HTTP error: {e}")
-                return f"AI service error: {str(e)}"
-                
-        except Exception as e:
-            logging.error(f"Unexpected error in ask_gemini: {e}")
-            return "An unexpected error occurred while processing your request. Please try again later."
-    
-    return "Maximum retry attempts reached. Please try again later."
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
 
-def ask_mistral(question, api_key, model="mistral-small-latest"):
-    """Mistral AI API integration with comprehensive error handling"""
-    if not api_key:
-        raise ValueError("Mistral API key is required")
-    
-    import socket
-    import time
-    
-    url = "https://api.mistral.ai/v1/chat/completions"
+    def is_idle(self, now: float) -> bool:
+        """Nobody is queued and both budgets have refilled, so a new limiter
+        for the same key would behave exactly the same"""
+        return (self.waiting == 0 and not self._turn.locked()
+                and self.requests.is_full(now) and self.tokens.is_full(now))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        self.requests.delay_for(0, now)
+        self.tokens.delay_for(0, now)
+        return {
+            "provider": self.provider,
+            "queue_depth": self.waiting,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": round(self.total_wait / self.acquired * 1000, 1) if self.acquired else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "requests_available": round(self.requests.tokens, 2),
+            "tokens_available": round(self.tokens.tokens),
+        }
+
+class RateLimiterRegistry:
+    """
+    Limiters keyed like ProviderClientRegistry, but without a size cap: a
+    limiter that is still draining its budget or has requests queued is never
+    dropped, however many keys are active, or its RPM/TPM would reset to a
+    full bucket. Idle limiters are swept out at most every `sweep_seconds`.
+    """
+
+    def __init__(self, sweep_seconds: float = 60.0):
+        self.sweep_seconds = sweep_seconds
+        self._limiters: Dict[str, ProviderRateLimiter] = {}
+        self._last_sweep = time.monotonic()
+        self.created = 0
+        self.evictions = 0
+
+    def _sweep(self, now: float):
+        if now - self._last_sweep < self.sweep_seconds:
+            return
+        self._last_sweep = now
+        for key in [key for key, limiter in self._limiters.items() if limiter.is_idle(now)]:
+            del self._limiters[key]
+            self.evictions += 1
+
+    def get(self, provider: str, api_key: str, factory) -> ProviderRateLimiter:
+        key = ProviderClientRegistry._key(provider, api_key)
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            self._sweep(time.monotonic())
+            limiter = self._limiters[key] = factory()
+            self.created += 1
+        return limiter
+
+    def items(self):
+        return list(self._limiters.items())
+
+rate_limiters = RateLimiterRegistry()
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting
+    return len(text) // 4 + 1
+
+def get_rate_limiter(provider: str, api_key: str) -> ProviderRateLimiter:
+    def create():
+        config = get_provider_config(provider)
+        rpm = float(os.getenv(f"{provider.upper()}_RPM", config["rpm"]))
+        tpm = float(os.getenv(f"{provider.upper()}_TPM", config["tpm"]))
+        return ProviderRateLimiter(provider, rpm, tpm)
+    return rate_limiters.get(provider, api_key or "", create)
+
+async def acquire_rate_limit(provider: str, api_key: str, question: str):
+    cost = estimate_tokens(question) + get_provider_config(provider)["max_output_tokens"]
+    await get_rate_limiter(provider, api_key).acquire(cost)
+
+@app.get("/medlife/metrics/rate-limits")
+async def rate_limit_metrics():
+    return {
+        "max_wait_seconds": RATE_LIMIT_MAX_WAIT_SECONDS,
+        "created": rate_limiters.created,
+        "evictions": rate_limiters.evictions,
+        # Only a short prefix of the key hash is exposed
+        "limiters": [
+            {"key": key.split(":")[0] + ":" + key.split(":")[1][:8], **limiter.stats()}
+            for key, limiter in rate_limiters.items()
+        ],
+    }
+
+#<<<<<<<<<<<<<<<<<PROVIDER CIRCUIT BREAKERS>>>>>>>>>>>>>>>>>>
+
+# After CIRCUIT_FAILURE_THRESHOLD consecutive outages (5xx, timeouts,
+# connection errors) a provider's circuit opens and calls fail fast, or go to
+# fallback_provider, for CIRCUIT_RECOVERY_SECONDS. Then one probe call is let
+# through (half-open); its outcome closes or re-opens the circuit.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RECOVERY_SECONDS = float(os.getenv("CIRCUIT_RECOVERY_SECONDS", "30"))
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, provider: str, failure_threshold: int, recovery_seconds: float):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_failure_at: Optional[float] = None
+
+    def before_call(self):
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_seconds:
+            self.state = self.HALF_OPEN
+        if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probe_in_flight):
+            self.rejected += 1
+            name = get_provider_config(self.provider)["name"]
+            raise CircuitOpenError(self.provider, f"{name} is temporarily unavailable. Please try again later.")
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = True
+
+    def release(self):
+        """The call ended without telling us anything about provider health"""
+        self.probe_in_flight = False
+
+    def record_result(self, failed: bool):
+        self.probe_in_flight = False
+        if not failed:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            return
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_failure_at = time.time()
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.warning(f"Circuit for {self.provider} opened after {self.consecutive_failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        retry_in = 0.0
+        if self.state == self.OPEN:
+            retry_in = max(0.0, self.recovery_seconds - (time.monotonic() - self.opened_at))
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "retry_in_seconds": round(retry_in, 1),
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "last_failure_at": self.last_failure_at,
+        }
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    breaker = _circuit_breakers.get(provider)
+    if breaker is None:
+        breaker = CircuitBreaker(provider, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RECOVERY_SECONDS)
+        _circuit_breakers[provider] = breaker
+    return breaker
+
+@app.get("/medlife/metrics/providers")
+async def provider_health():
+    return {
+        provider: {**get_circuit_breaker(provider).stats(), **latency_summary(provider)}
+        for provider in AI_PROVIDERS
+    }
+
+SYSTEM_PROMPT = "You are a helpful healthcare AI assistant. Provide accurate, helpful medical information while reminding users to consult healthcare professionals for medical advice."
+
+#<<<<<<<<<<<<<<<<<PROMPT CACHING>>>>>>>>>>>>>>>>>>
+
+# The system prompt and a member's patient-details prefix are the same on
+# every question about that member, so they go first and unchanged, as the
+# system message, where providers can serve them from their prompt cache:
+# automatic prefix caching for OpenAI, Mistral and Gemini, an explicit
+# cache_control breakpoint for Claude. Providers only cache prefixes above a
+# minimum size (1024 tokens for OpenAI and most Claude models), so short
+# profiles are billed as before; prompt_cache_stats shows what was cached.
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "true").lower() == "true"
+
+prompt_cache_stats: Dict[str, dict] = {}
+
+def system_prompt_text(prefix: str = "") -> str:
+    return f"{SYSTEM_PROMPT}\n\n{prefix}" if prefix else SYSTEM_PROMPT
+
+def claude_system(prefix: str = ""):
+    if not prefix:
+        return SYSTEM_PROMPT
+    block = {"type": "text", "text": system_prompt_text(prefix)}
+    if PROMPT_CACHE_ENABLED:
+        block["cache_control"] = {"type": "ephemeral"}
+    return [block]
+
+def gemini_payload(question: str, prefix: str = "") -> dict:
+    if not prefix:
+        return {"contents": [{"parts": [{"text": f"{SYSTEM_PROMPT}\n\nQuestion: {question}"}]}]}
+    return {
+        "systemInstruction": {"parts": [{"text": system_prompt_text(prefix)}]},
+        "contents": [{"role": "user", "parts": [{"text": question}]}],
+    }
+
+def record_prompt_usage(provider: str, usage):
+    """Count prompt and cache-read tokens from a provider's usage block"""
+    if not isinstance(usage, dict):
+        return
+    written = 0
+    if provider == "claude":
+        cached = usage.get("cache_read_input_tokens") or 0
+        written = usage.get("cache_creation_input_tokens") or 0
+        total = (usage.get("input_tokens") or 0) + cached + written
+    elif provider == "gemini":
+        total = usage.get("promptTokenCount") or 0
+        cached = usage.get("cachedContentTokenCount") or 0
+    else:
+        total = usage.get("prompt_tokens") or 0
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    stats = prompt_cache_stats.setdefault(
+        provider, {"calls": 0, "cache_hits": 0, "input_tokens": 0, "cached_tokens": 0, "cache_write_tokens": 0}
+    )
+    stats["calls"] += 1
+    stats["cache_hits"] += 1 if cached else 0
+    stats["input_tokens"] += total
+    stats["cached_tokens"] += cached
+    stats["cache_write_tokens"] += written
+
+@app.get("/medlife/metrics/prompt-cache")
+async def prompt_cache_metrics():
+    return {
+        "enabled": PROMPT_CACHE_ENABLED,
+        "providers": {
+            provider: {
+                **stats,
+                "cached_ratio": round(stats["cached_tokens"] / stats["input_tokens"], 4) if stats["input_tokens"] else 0.0,
+            }
+            for provider, stats in prompt_cache_stats.items()
+        },
+    }
+
+#<<<<<<<<<<<<<<<<<PROVIDER CALLS>>>>>>>>>>>>>>>>>>
+
+def is_dns_error(e: Exception) -> bool:
+    msg = str(e)
+    return ("Name or service not known" in msg or "getaddrinfo failed" in msg
+            or "nodename nor servname" in msg or "Temporary failure in name resolution" in msg)
+
+def raise_for_provider_status(provider: str, response: httpx.Response):
+    """Translate a provider HTTP error response into a ProviderError"""
+    if response.status_code < 400:
+        return
+    name = get_provider_config(provider)["name"]
+    try:
+        err = response.json()
+    except Exception:
+        err = {"message": response.text}
+    msg = ""
+    if isinstance(err, dict):
+        error_obj = err.get("error", {})
+        if isinstance(error_obj, dict):
+            msg = error_obj.get("message", "")
+    if response.status_code == 401:
+        raise ProviderAuthError(provider, f"Invalid {name} API key. Please check your API key.")
+    if response.status_code == 429:
+        raise ProviderRateLimitError(provider, f"{name} API rate limit exceeded. Please try again later.")
+    if response.status_code >= 500:
+        logging.error(f"{name} {response.status_code} error: {err}")
+        raise ProviderUnavailableError(provider, f"{name} service is temporarily unavailable. Please try again later.")
+    if response.status_code == 400 and "credit balance is too low" in msg.lower():
+        raise ProviderCreditsError(
+            provider,
+            f"{name} is unavailable for this account right now (insufficient credits). "
+            "Add credits in your provider billing or pass a fallback_provider to continue."
+        )
+    logging.error(f"{name} {response.status_code} error: {err}")
+    raise ProviderRequestError(provider, f"{name} request was invalid. Details: {err}")
+
+async def post_provider_json(provider: str, url: str, payload: dict, headers: dict):
+    """POST to a provider with exponential backoff on DNS failures and timeouts"""
+    name = get_provider_config(provider)["name"]
+    client = get_provider_http_client(provider)
+    max_retries = 3
+    retry_delay = 1
+
+    for attempt in range(max_retries):
+        try:
+            response = await client.post(url, json=payload, headers=headers)
+        except httpx.ConnectError as e:
+            if not is_dns_error(e):
+                logging.error(f"Connection error: {e}")
+                raise ProviderUnavailableError(provider, f"Unable to connect to the {name} service. Please check your internet connection.") from e
+            logging.error(f"DNS resolution error on attempt {attempt + 1}: {e}")
+            if attempt == max_retries - 1:
+                raise ProviderUnavailableError(provider, "DNS resolution failed. Please check your DNS settings or internet connection.") from e
+        except httpx.TimeoutException as e:
+            logging.error(f"Request timeout on attempt {attempt + 1}")
+            if attempt == max_retries - 1:
+                raise ProviderUnavailableError(provider, f"Request timeout. The {name} service is taking longer than expected to respond.") from e
+        except httpx.HTTPError as e:
+            # Dropped connections, protocol errors: the request may have been
+            # processed, so report it rather than retry
+            logging.error(f"HTTP error calling {name}: {e!r}")
+            raise ProviderUnavailableError(provider, f"The connection to the {name} service failed. Please try again.") from e
+        else:
+            raise_for_provider_status(provider, response)
+            try:
+                return response.json()
+            except ValueError as e:
+                raise ProviderError(provider, f"{name} returned an unreadable response.") from e
+        await asyncio.sleep(retry_delay * (2 ** attempt))
+
+def openai_provider_error(e: Exception) -> ProviderError:
+    """Map OpenAI SDK exceptions onto the shared ProviderError types"""
+    message = f"OpenAI API error: {str(e)}"
+    if isinstance(e, openai.AuthenticationError):
+        return ProviderAuthError("openai", message)
+    if isinstance(e, openai.RateLimitError):
+        if "insufficient_quota" in str(getattr(e, "code", "") or ""):
+            return ProviderCreditsError("openai", message)
+        return ProviderRateLimitError("openai", message)
+    if isinstance(e, (openai.APIConnectionError, openai.InternalServerError)):
+        # APITimeoutError is a subclass of APIConnectionError
+        return ProviderUnavailableError("openai", message)
+    if isinstance(e, openai.APIStatusError):
+        return ProviderRequestError("openai", message)
+    return ProviderError("openai", message)
+
+async def ask_openai(question, api_key, provider="openai", model=None, prefix=""):
+    """OpenAI API integration"""
+    if not api_key:
+        raise ValueError("OpenAI API key is required")
+
+    client = get_openai_client(api_key)
+
+    if not model:
+        model = "gpt-3.5-turbo"
+
+    messages = [
+        {"role": "system", "content": system_prompt_text(prefix)},
+        {"role": "user", "content": question}
+    ]
+
+    try:
+        completion = await client.chat.completions.create(
+            messages=messages,
+            model=model,
+            max_tokens=1000,
+            temperature=0.7
+        )
+        if completion.usage:
+            record_prompt_usage("openai", completion.usage.model_dump())
+        return completion.choices[0].message.content
+    except Exception as e:
+        raise openai_provider_error(e) from e
+
+async def ask_gemini(question, api_key, model="gemini-2.0-flash", prefix=""):
+    "Google Gemini API integration with enhanced error handling"
+    if not api_key:
+        raise ValueError("Google Gemini API key is required")
+
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent"
+    headers = {
+        "Content-Type": "application/json",
+        "X-goog-api-key": api_key
+    }
+    payload = {
+        **gemini_payload(question, prefix),
+        "generationConfig": {
+            "temperature": 0.7,
+            "topP": 0.8,
+            "maxOutputTokens": 1000
+        }
+    }
+
+    data = await post_provider_json("gemini", url, payload, headers)
+    record_prompt_usage("gemini", data.get("usageMetadata"))
+    candidates = data.get("candidates") or [{}]
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    text = "".join(part.get("text", "") for part in parts if isinstance(part, dict))
+    if text:
+        return text
+    reason = candidates[0].get("finishReason")
+    if reason and reason != "STOP":
+        # e.g. SAFETY or RECITATION: the candidate comes back without content
+        raise ProviderError("gemini", f"The AI service returned no answer (finish reason: {reason}).")
+    raise ProviderError("gemini", "No response received from the AI service.")
+
+async def ask_mistral(question, api_key, model="mistral-small-latest", prefix=""):
+    """Mistral AI API integration with comprehensive error handling"""
+    if not api_key:
+        raise ValueError("Mistral API key is required")
+
+    url = "https://api.mistral.ai/v1/chat/completions"
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -509,99 +1580,26 @@ def ask_mistral(question, api_key, model="mistral-small-latest"):
     payload = {
         "model": model,
         "messages": [
-            {"role": "system", "content": "You are a helpful healthcare AI assistant. Provide accurate, helpful medical information while reminding users to consult healthcare professionals for medical advice."},
+            {"role": "system", "content": system_prompt_text(prefix)},
             {"role": "user", "content": question}
         ],
         "max_tokens": 1000,
         "temperature": 0.7
     }
-    
-    # Retry mechanism with exponential backoff
-    max_retries = 3
-    retry_delay = 1
-    
-    for attempt in range(max_retries):
-        try:
-            # Test DNS resolution first
-            try:
-                socket.gethostbyname('api.mistral.ai')
-            except socket.gaierror as dns_error:
-                logging.error(f"DNS resolution failed for api.mistral.ai: {dns_error}")
-                return f"DNS resolution failed. Please check your internet connection or DNS settings. Error: {str(dns_error)}"
-            
-            response = requests.post(
-                url,
-                json=payload,
-                headers=headers,
-                timeout=30
-            )
-            
-            if response.status_code == 401:
-                return "Invalid Mistral API key. Please check your API key and try again."
-            elif response.status_code == 429:
-                return "Mistral API rate limit exceeded. Please try again later."
-            elif response.status_code == 500:
-                return "Mistral service is temporarily unavailable. Please try again later."
-            elif response.status_code == 400:
-                try:
-                    err = response.json()
-                except Exception:
-                    err = {"message": response.text}
-                logging.error(f"Mistral 400 error: {err}")
-                return f"Mistral request was invalid. Details: {err}"
-            
-            response.raise_for_status()
-            data = response.json()
-            
-            if "choices" in data and data["choices"]:
-                return data["choices"][0]["message"]["content"]
-            else:
-                return "No response received from the Mistral AI service."
-                
-        except requests.exceptions.ConnectionError as e:
-            if "NameResolutionError" in str(e) or "getaddrinfo failed" in str(e):
-                logging.error(f"DNS resolution error on attempt {attempt + 1}: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay * (2 ** attempt))
-                    continue
-                return "DNS resolution failed. Please check your DNS settings or internet connection."
-            else:
-                logging.error(f"Connection error: {e}")
-                return "Unable to connect to the Mistral AI service. Please check your internet connection."
-                
-        except requests.exceptions.Timeout:
-            logging.error(f"Request timeout on attempt {attempt + 1}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay * (2 ** attempt))
-                continue
-            return "Request timeout. The Mistral AI service is taking longer than expected to respond."
-            
-        except requests.exceptions.HTTPError as e:
-            response = e.response
-            if response and response.status_code == 429:
-                return "Mistral API rate limit exceeded. Please try again later."
-            elif response and response.status_code == 401:
-                return "Invalid Mistral API key. Please check your API key and try again."
-            elif response and response.status_code == 500:
-                return "Mistral service is temporarily unavailable. Please try again later."
-            else:
-                logging.error(f"HTTP error: {e}")
-                return f"Mistral AI service error: {str(e)}"
-                
-        except Exception as e:
-            logging.error(f"Unexpected error in ask_mistral: {e}")
-            return "An unexpected error occurred while processing your request. Please try again later."
-    
-    return "Maximum retry attempts reached. Please try again later."
 
-def ask_claude(question, api_key, model="claude-3-haiku-20240307", _fallback=None):
+    data = await post_provider_json("mistral", url, payload, headers)
+    record_prompt_usage("mistral", data.get("usage"))
+    choices = data.get("choices") or [{}]
+    content = (choices[0].get("message") or {}).get("content")
+    if content:
+        return content
+    raise ProviderError("mistral", "No response received from the Mistral AI service.")
+
+async def ask_claude(question, api_key, model="claude-3-haiku-20240307", _fallback=None, prefix=""):
     """Claude (Anthropic) integration using the Messages API schema, tuned for free/low-credit accounts."""
     if not api_key:
         raise ValueError("Claude API key is required")
-    
-    import socket
-    import time
-    
+
     url = "https://api.anthropic.com/v1/messages"
     headers = {
         "x-api-key": api_key,
@@ -613,132 +1611,316 @@ def ask_claude(question, api_key, model="claude-3-haiku-20240307", _fallback=Non
         "model": model,           # default to Haiku (cheapest)
         "max_tokens": 256,        # smaller to fit tight free budgets
         "temperature": 0.7,
-        "system": "You are a helpful healthcare AI assistant. Provide accurate, helpful medical information while reminding users to consult healthcare professionals for medical advice.",
+        "system": claude_system(prefix),
         "messages": [
             {"role": "user", "content": question}
         ]
     }
-    
-    # Retry mechanism with exponential backoff
-    max_retries = 3
-    retry_delay = 1
-    
-    for attempt in range(max_retries):
-        try:
-            # DNS check
+
+    data = await post_provider_json("claude", url, payload, headers)
+    record_prompt_usage("claude", data.get("usage"))
+
+    # Messages API returns list of content blocks
+    if "content" in data and isinstance(data["content"], list) and data["content"]:
+        for block in data["content"]:
+            if block.get("type") == "text" and "text" in block:
+                return block["text"]
+        text = " ".join([b.get("text", "") for b in data["content"] if isinstance(b, dict)]).strip()
+        if text:
+            return text
+    raise ProviderError("claude", "No response received from the Claude AI service.")
+
+AI_PROVIDERS = {
+    "openai": ask_openai,
+    "gemini": ask_gemini,
+    "mistral": ask_mistral,
+    "claude": ask_claude,
+}
+
+async def call_provider(provider, question, api_key, model=None, prefix=""):
+    """One provider call behind its circuit breaker and rate limiter"""
+    breaker = get_circuit_breaker(provider)
+    breaker.before_call()
+    started = None
+    try:
+        await acquire_rate_limit(provider, api_key, prefix + question)
+        started = time.monotonic()
+        answer = await AI_PROVIDERS[provider](question, api_key, model=model, prefix=prefix)
+    except RateLimitTimeout:
+        # Never reached the provider, so it says nothing about its health
+        breaker.release()
+        raise
+    except ProviderError as e:
+        breaker.record_result(failed=e.trips_breaker)
+        raise
+    except asyncio.CancelledError:
+        breaker.release()
+        if started is not None:
+            # A primary that lost a hedge race took at least this long; leaving
+            # it out would pull the hedge percentile down over fast calls only
+            record_provider_latency(provider, time.monotonic() - started)
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    breaker.record_result(failed=False)
+    record_provider_latency(provider, time.monotonic() - started)
+    return answer
+
+def fallback_api_key(provider: str, fallback: Optional[str]) -> Optional[str]:
+    if fallback not in AI_PROVIDERS or fallback == provider:
+        return None
+    return os.getenv(f"{fallback.upper()}_API_KEY")
+
+async def call_fallback(primary_error, provider, fallback, question, fb_key, prefix=""):
+    logging.warning(f"{provider} failed ({primary_error}); falling back to {fallback}")
+    try:
+        return await call_provider(fallback, question, fb_key, get_provider_config(fallback)["models"][0], prefix)
+    except (ProviderError, ValueError):
+        raise primary_error  # don't break existing behavior
+
+async def ask_provider(question, api_key, provider="openai", model=None, fallback=None, hedge=False, prefix=""):
+    """Unified function to handle all AI providers. Optional fallback keeps UX alive without changing defaults.
+    `prefix` is the stable part of the prompt, sent where providers can cache it."""
+    if provider not in AI_PROVIDERS:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+    fb_key = fallback_api_key(provider, fallback)
+    if hedge and fb_key:
+        return await ask_hedged(question, api_key, provider, model, fallback, fb_key, prefix)
+
+    try:
+        return await call_provider(provider, question, api_key, model, prefix)
+    except (ProviderCreditsError, ProviderUnavailableError) as primary_error:
+        # Out of credits, down, or circuit open: use the fallback if one is configured
+        if not fb_key:
+            raise
+        return await call_fallback(primary_error, provider, fallback, question, fb_key, prefix)
+
+#<<<<<<<<<<<<<<<<<HEDGED REQUESTS>>>>>>>>>>>>>>>>>>
+
+# In hedge mode the fallback provider is started alongside the primary once
+# the primary has run longer than HEDGE_PERCENTILE of its recent latency.
+# Whichever answers first wins and the other call is cancelled. Only the slow
+# tail is hedged, so extra spend stays around (100 - HEDGE_PERCENTILE)%.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", "10"))
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "200"))
+
+_provider_latencies: Dict[str, deque] = {}
+hedge_stats = {"requests": 0, "hedged": 0, "primary_wins": 0, "fallback_wins": 0}
+
+def record_provider_latency(provider: str, seconds: float):
+    samples = _provider_latencies.get(provider)
+    if samples is None:
+        samples = _provider_latencies[provider] = deque(maxlen=LATENCY_WINDOW)
+    samples.append(seconds)
+
+def latency_percentile(provider: str, percentile: float) -> Optional[float]:
+    samples = sorted(_provider_latencies.get(provider, ()))
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+    return samples[index]
+
+def latency_summary(provider: str) -> dict:
+    summary = {"latency_samples": len(_provider_latencies.get(provider, ()))}
+    for percentile in (50, 95, 99):
+        value = latency_percentile(provider, percentile)
+        summary[f"latency_p{percentile}_seconds"] = round(value, 3) if value is not None else None
+    return summary
+
+def hedge_delay(provider: str) -> float:
+    if len(_provider_latencies.get(provider, ())) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    return latency_percentile(provider, HEDGE_PERCENTILE)
+
+async def ask_hedged(question, api_key, provider, model, fallback, fb_key, prefix=""):
+    hedge_stats["requests"] += 1
+    fb_model = get_provider_config(fallback)["models"][0]
+    primary = asyncio.ensure_future(call_provider(provider, question, api_key, model, prefix))
+    pending = {primary}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedge_delay(provider))
+        if done:
             try:
-                socket.gethostbyname('api.anthropic.com')
-            except socket.gaierror as dns_error:
-                logging.error(f"DNS resolution failed for api.anthropic.com: {dns_error}")
-                return f"DNS resolution failed. Please check your internet connection or DNS settings. Error: {str(dns_error)}"
-            
-            response = requests.post(
-                url,
-                json=payload,
-                headers=headers,
-                timeout=30
-            )
+                answer = primary.result()
+            except (ProviderCreditsError, ProviderUnavailableError) as primary_error:
+                return await call_fallback(primary_error, provider, fallback, question, fb_key, prefix)
+            hedge_stats["primary_wins"] += 1
+            return answer
 
-            if response.status_code in (400, 401, 429, 500):
-                try:
-                    err = response.json()
-                except Exception:
-                    err = {"message": response.text}
-                msg = ""
-                if isinstance(err, dict):
-                    error_obj = err.get("error", {})
-                    if isinstance(error_obj, dict):
-                        msg = error_obj.get("message", "")
-                # Translate common errors to clear app responses
-                if response.status_code == 401:
-                    return "Invalid Claude API key. Please check your API key."
-                if response.status_code == 429:
-                    return "Claude API rate limit exceeded. Please try again later."
-                if response.status_code == 500:
-                    return "Claude service is temporarily unavailable. Please try again later."
-                if response.status_code == 400 and "credit balance is too low" in msg.lower():
-                    # Keep it explicit so the UI can react
-                    return ("Claude is unavailable for this account right now (insufficient credits). "
-                            "Add credits in Anthropic Billing or pass a fallback_provider to continue.")
-                logging.error(f"Claude 400 error: {err}")
-                return f"Claude request was invalid. Details: {err}"
-            
-            response.raise_for_status()
-            data = response.json()
-
-            # Messages API returns list of content blocks
-            if "content" in data and isinstance(data["content"], list) and data["content"]:
-                for block in data["content"]:
-                    if block.get("type") == "text" and "text" in block:
-                        return block["text"]
-                return " ".join([b.get("text", "") for b in data["content"] if isinstance(b, dict)]).strip() or "No response received from the Claude AI service."
-            else:
-                return "No response received from the Claude AI service."
-                
-        except requests.exceptions.ConnectionError as e:
-            if "NameResolutionError" in str(e) or "getaddrinfo failed" in str(e):
-                logging.error(f"DNS resolution error on attempt {attempt + 1}: {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(retry_delay * (2 ** attempt))
-                    continue
-                return "DNS resolution failed. Please check your DNS settings or internet connection."
-            else:
-                logging.error(f"Connection error: {e}")
-                return "Unable to connect to the Claude AI service. Please check your internet connection."
-                
-        except requests.exceptions.Timeout:
-            logging.error(f"Request timeout on attempt {attempt + 1}")
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay * (2 ** attempt))
-                continue
-            return "Request timeout. The Claude AI service is taking longer than expected to respond."
-            
-        except requests.exceptions.HTTPError as e:
-            response = e.response
-            if response and response.status_code == 429:
-                return "Claude API rate limit exceeded. Please try again later."
-            elif response and response.status_code == 401:
-                return "Invalid Claude API key. Please check your API key."
-            elif response and response.status_code == 500:
-                return "Claude service is temporarily unavailable. Please try again later."
-            else:
-                logging.error(f"Claude HTTP error: {e}")
-                return f"Claude AI service error: {str(e)}"
-                
-        except Exception as e:
-            logging.error(f"Unexpected error in ask_claude: {e}")
-            return "An unexpected error occurred while processing your request. Please try again later."
-    
-    return "Maximum retry attempts reached. Please try again later."
+        hedge_stats["hedged"] += 1
+        logging.info(f"Hedging slow {provider} request with {fallback}")
+        backup = asyncio.ensure_future(call_provider(fallback, question, fb_key, fb_model, prefix))
+        pending = {primary, backup}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    hedge_stats["primary_wins" if task is primary else "fallback_wins"] += 1
+                    return task.result()
+        # Both failed: report the primary's error, as the non-hedged path does
+        return primary.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+@app.get("/medlife/metrics/hedging")
+async def hedging_metrics():
+    return {
+        **hedge_stats,
+        "enabled_by_default": HEDGE_ENABLED,
+        "percentile": HEDGE_PERCENTILE,
+        "delays_seconds": {provider: round(hedge_delay(provider), 3) for provider in AI_PROVIDERS},
+    }
+
+#<<<<<<<<<<<<<<<<<STREAMING PROVIDERS>>>>>>>>>>>>>>>>>>
+
+# Each stream_* generator yields plain text deltas as the provider produces
+# them; the SSE endpoint wraps them in one common chunk format.
+
+async def iter_sse_data(response: httpx.Response):
+    """Yield the payload of every `data:` line from a provider SSE response"""
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            data = line[5:].strip()
+            if data and data != "[DONE]":
+                yield data
+
+async def raise_for_stream_status(response: httpx.Response, provider: str):
+    if response.status_code < 400:
+        return
+    await response.aread()
+    raise_for_provider_status(provider, response)
+
+async def stream_openai(question, api_key, model=None, prefix=""):
+    if not api_key:
+        raise ValueError("OpenAI API key is required")
+    client = get_openai_client(api_key)
+    try:
+        stream = await client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": system_prompt_text(prefix)},
+                {"role": "user", "content": question}
+            ],
+            model=model or "gpt-3.5-turbo",
+            max_tokens=1000,
+            temperature=0.7,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                record_prompt_usage("openai", chunk.usage.model_dump())
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except openai.OpenAIError as e:
+        raise openai_provider_error(e) from e
+
+async def stream_gemini(question, api_key, model="gemini-2.0-flash", prefix=""):
+    if not api_key:
+        raise ValueError("Google Gemini API key is required")
+    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:streamGenerateContent?alt=sse"
+    headers = {"Content-Type": "application/json", "X-goog-api-key": api_key}
+    payload = {
+        **gemini_payload(question, prefix),
+        "generationConfig": {"temperature": 0.7, "topP": 0.8, "maxOutputTokens": 1000}
+    }
+    client = get_provider_http_client("gemini")
+    async with client.stream("POST", url, json=payload, headers=headers) as response:
+        await raise_for_stream_status(response, "gemini")
+        usage = None
+        async for data in iter_sse_data(response):
+            event = json.loads(data)
+            # Every event repeats the running usage; the last one is final
+            usage = event.get("usageMetadata") or usage
+            for candidate in event.get("candidates", []):
+                for part in candidate.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        yield part["text"]
+        record_prompt_usage("gemini", usage)
+
+async def stream_mistral(question, api_key, model="mistral-small-latest", prefix=""):
+    if not api_key:
+        raise ValueError("Mistral API key is required")
+    url = "https://api.mistral.ai/v1/chat/completions"
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt_text(prefix)},
+            {"role": "user", "content": question}
+        ],
+        "max_tokens": 1000,
+        "temperature": 0.7,
+        "stream": True
+    }
+    client = get_provider_http_client("mistral")
+    async with client.stream("POST", url, json=payload, headers=headers) as response:
+        await raise_for_stream_status(response, "mistral")
+        async for data in iter_sse_data(response):
+            event = json.loads(data)
+            if event.get("usage"):
+                record_prompt_usage("mistral", event["usage"])
+            for choice in event.get("choices", []):
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    yield content
+
+async def stream_claude(question, api_key, model="claude-3-haiku-20240307", prefix=""):
+    if not api_key:
+        raise ValueError("Claude API key is required")
+    url = "https://api.anthropic.com/v1/messages"
+    headers = {
+        "x-api-key": api_key,
+        "Content-Type": "application/json",
+        "anthropic-version": "2023-06-01"
+    }
+    payload = {
+        "model": model,
+        "max_tokens": 256,
+        "temperature": 0.7,
+        "system": claude_system(prefix),
+        "messages": [{"role": "user", "content": question}],
+        "stream": True
+    }
+    client = get_provider_http_client("claude")
+    async with client.stream("POST", url, json=payload, headers=headers) as response:
+        await raise_for_stream_status(response, "claude")
+        async for data in iter_sse_data(response):
+            event = json.loads(data)
+            if event.get("type") == "message_start":
+                # Input and cache token counts are only reported here
+                record_prompt_usage("claude", (event.get("message") or {}).get("usage"))
+            elif event.get("type") == "content_block_delta":
+                text = (event.get("delta") or {}).get("text")
+                if text:
+                    yield text
+            elif event.get("type") == "error":
+                error = event.get("error") or {}
+                message = f"Claude stream error: {error.get('message', '')}"
+                if error.get("type") in ("overloaded_error", "api_error"):
+                    raise ProviderUnavailableError("claude", message)
+                raise ProviderError("claude", message)
 
-def ask_provider(question, api_key, provider="openai", model=None, fallback=None):
-    """Unified function to handle all AI providers. Optional fallback keeps UX alive without changing defaults."""
+def stream_provider(question, api_key, provider="openai", model=None, prefix=""):
+    """Return an async iterator of text deltas for the given provider"""
     providers = {
-        "openai": ask_openai,
-        "gemini": ask_gemini,
-        "mistral": ask_mistral,
-        "claude": ask_claude,
+        "openai": stream_openai,
+        "gemini": stream_gemini,
+        "mistral": stream_mistral,
+        "claude": stream_claude,
     }
     if provider not in providers:
         raise ValueError(f"Unsupported provider: {provider}")
+    return providers[provider](question, api_key, model, prefix=prefix)
 
-    primary = providers[provider](question, api_key, model)
-
-    # If Claude is out of credits and a fallback is provided, try it
-    if (provider == "claude"
-        and isinstance(primary, str)
-        and "insufficient credits" in primary.lower()
-        and fallback in providers):
-        fb_key = os.getenv(f"{fallback.upper()}_API_KEY")
-        if not fb_key:
-            # No env key? just return the primary message
-            return primary
-        try:
-            return providers[fallback](question, fb_key, None)
-        except Exception as _:
-            return primary  # don't break existing behavior
-
-    return primary
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
 
 '''
 myself means account holder email owner.
@@ -751,59 +1933,33 @@ from fastapi import Depends
 from fastapi import Body
 
 @app.post("/medlife/addmember")
-async def add_member(data: Data = Body(...)):
+@runs_in_db_executor
+def add_member(data: Data = Body(...)):
     email = data.email
 
     conn = get_db_connection()
     try:
-        cursor = conn.execute("SELECT * FROM family_members WHERE email = ?", (email,))
-        record = cursor.fetchone()
-
-        if not record:
-            conn.execute(
-                """
-                INSERT INTO family_members (
-                    email,
-                    member1_firstName, member1_lastName, member1_dob, member1_race, member1_gender,
-                    member1_height, member1_weight, member1_a1c, member1_bloodPressure, member1_medicine, member1_tokens
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    email,
-                    data.firstName, data.lastName, data.dob, data.race, data.gender,
-                    data.height, data.weight, data.a1c, data.bloodPressure, data.medicine, data.tokens
-                )
-            )
-            conn.commit()
-            return {"message": "member1 added successfully"}
-        else:
-            for i in range(1, 5):
-                if not record[f"member{i}_firstName"]:
-                    conn.execute(
-                        f"""
-                        UPDATE family_members SET
-                            member{i}_firstName = ?,
-                            member{i}_lastName = ?,
-                            member{i}_dob = ?,
-                            member{i}_race = ?,
-                            member{i}_gender = ?,
-                            member{i}_height = ?,
-                            member{i}_weight = ?,
-                            member{i}_a1c = ?,
-                            member{i}_bloodPressure = ?,
-                            member{i}_medicine = ?,
-                            member{i}_tokens = ?
-                        WHERE email = ?
-                        """,
-                        (
-                            data.firstName, data.lastName, data.dob, data.race, data.gender,
-                            data.height, data.weight, data.a1c, data.bloodPressure, data.medicine, data.tokens,
-                            email
-                        )
-                    )
-                    conn.commit()
-                    return {"message": f"member{i} added successfully"}
+        ensure_members_migrated(conn, email)
+        # IMMEDIATE takes the write lock up front so two concurrent adds
+        # cannot both claim the same free slot
+        conn.execute("BEGIN IMMEDIATE")
+        if not account_exists(conn, email):
+            conn.execute("INSERT INTO family_members (email, migrated) VALUES (?, 1)", (email,))
+        # Take the first empty slot; editmember can fill slots out of order
+        member_index = lowest_free_member_index(conn, email)
+        if member_index is None:
             raise HTTPException(status_code=400, detail="Maximum of 4 members allowed per user.")
+        conn.execute(
+            """
+            INSERT INTO members (email, member_index, first_name, last_name, dob, race, gender,
+                                 height, weight, a1c, blood_pressure, medicine, tokens)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (email, member_index, *member_values(data))
+        )
+        conn.commit()
+        member_profile_cache.invalidate(email)
+        return {"message": f"member{member_index} added successfully"}
     finally:
         conn.close()
 
@@ -812,56 +1968,46 @@ async def add_member(data: Data = Body(...)):
 from fastapi import Body
 
 @app.post("/medlife/editmember")
-async def edit_member(member_index: int, data: Data = Body(...)):
+@runs_in_db_executor
+def edit_member(member_index: int, data: Data = Body(...)):
     email = data.email
     conn = get_db_connection()
     try:
-        cursor = conn.execute(
-            "SELECT * FROM family_members WHERE email = ?", 
-            (email,)
-        )
-        row = cursor.fetchone()
-        
-        if not row:
+        if not account_exists(conn, email):
             raise HTTPException(status_code=404, detail="User not found")
-        
+
         if member_index < 1 or member_index > 4:
             raise HTTPException(status_code=400, detail="Invalid member index")
-        
-        # Update the specific member with correct prefixed columns
-        conn.execute(
-            f"""
-            UPDATE family_members
-            SET 
-                member{member_index}_firstName = ?,
-                member{member_index}_lastName = ?,
-                member{member_index}_dob = ?,
-                member{member_index}_race = ?,
-                member{member_index}_gender = ?,
-                member{member_index}_height = ?,
-                member{member_index}_weight = ?,
-                member{member_index}_a1c = ?,
-                member{member_index}_bloodPressure = ?,
-                member{member_index}_medicine = ?,
-                member{member_index}_tokens = ?
-            WHERE email = ?
-            """,
-            (
-                data.firstName,
-                data.lastName,
-                data.dob,
-                data.race,
-                data.gender,
-                data.height,
-                data.weight,
-                data.a1c,
-                data.bloodPressure,
-                data.medicine,
-                data.tokens,
-                email
+
+        ensure_members_migrated(conn, email)
+        # IMMEDIATE so the slot lookup and a possible INSERT into an empty
+        # slot happen under one write lock, as in add_member
+        conn.execute("BEGIN IMMEDIATE")
+        row = fetch_member(conn, email, member_index)
+        detach_token_counters(conn, email)
+        invalidate_member_answers(conn, email, {
+            f"{row['first_name']}_{row['last_name']}" if row else None,
+            f"{data.firstName}_{data.lastName}",
+        })
+
+        if row:
+            assignments = ", ".join(f"{column} = ?" for column in MEMBER_COLUMNS.values())
+            conn.execute(
+                f"UPDATE members SET {assignments} WHERE id = ?",
+                (*member_values(data), row["id"])
+            )
+        else:
+            # Editing an empty slot fills it, as the column layout did
+            conn.execute(
+                """
+                INSERT INTO members (email, member_index, first_name, last_name, dob, race, gender,
+                                     height, weight, a1c, blood_pressure, medicine, tokens)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (email, member_index, *member_values(data))
             )
-        )
         conn.commit()
+        member_profile_cache.invalidate(email)
     finally:
         conn.close()
     return {"message": "Member updated successfully"}
@@ -872,36 +2018,12 @@ from fastapi import Depends
 from fastapi import Query
 
 @app.get("/medlife/getmember")
-async def get_member(email: str = Query(...)):
-    conn = get_db_connection()
-    try:
-        cursor = conn.execute(
-            "SELECT * FROM family_members WHERE email = ?",
-            (email,)
-        )
-        row = cursor.fetchone()
-        if not row:
-            return {"members": []}
-        members = []
-        for i in range(1, 5):
-            prefix = f"member{i}_"
-            if row[prefix + "firstName"]:
-                member = {
-                    "firstName": row[prefix + "firstName"],
-                    "lastName": row[prefix + "lastName"],
-                    "dob": row[prefix + "dob"],
-                    "race": row[prefix + "race"],
-                    "gender": row[prefix + "gender"],
-                    "height": row[prefix + "height"],
-                    "weight": row[prefix + "weight"],
-                    "a1c": row[prefix + "a1c"],
-                    "bloodPressure": row[prefix + "bloodPressure"],
-                    "medicine": row[prefix + "medicine"],
-                    "tokens": row[prefix + "tokens"] or 0
-                }
-                members.append(member)
-    finally:
-        conn.close()
+@runs_in_db_executor
+def get_member(email: str = Query(...)):
+    members = [
+        {field: member[field] for field in MEMBER_COLUMNS}
+        for member in get_member_profile(email)["members"]
+    ]
     return {"members": members}
 
 #<<<<<<<<<<<<<<<<<DELETE MEMBER ENDPOINT>>>>>>>>>>>>>>>>>>
@@ -912,132 +2034,809 @@ class DeleteMemberRequest(BaseModel):
 from fastapi import Query
 
 @app.delete("/medlife/deletemember")
-async def delete_member(email: str = Query(...), member_index: int = Query(...)):
+@runs_in_db_executor
+def delete_member(email: str = Query(...), member_index: int = Query(...)):
     """
     Delete a specific family member from the database by member index (1-4)
     """
     conn = get_db_connection()
     try:
-        cursor = conn.execute(
-            "SELECT * FROM family_members WHERE email = ?", 
-            (email,)
-        )
-        row = cursor.fetchone()
-        
-        if not row:
+        if not account_exists(conn, email):
             raise HTTPException(status_code=404, detail="User not found")
-        
+
         if member_index < 1 or member_index > 4:
             raise HTTPException(status_code=400, detail="Invalid member index. Must be between 1 and 4")
-        
-        # Check if the member exists
-        prefix = f"member{member_index}_"
-        if not row[prefix + "firstName"]:
+
+        ensure_members_migrated(conn, email)
+        detach_token_counters(conn, email)
+        deleted = conn.execute(
+            "DELETE FROM members WHERE email = ? AND member_index = ?",
+            (email, member_index)
+        ).rowcount
+        if not deleted:
             raise HTTPException(status_code=404, detail=f"Member {member_index} not found")
-        
-        # Shift members up after the deleted member
-        for i in range(member_index, 4):
-            next_prefix = f"member{i+1}_"
-            current_prefix = f"member{i}_"
-            conn.execute(
-                f"""
-                UPDATE family_members SET
-                    {current_prefix}firstName = ?,
-                    {current_prefix}lastName = ?,
-                    {current_prefix}dob = ?,
-                    {current_prefix}race = ?,
-                    {current_prefix}gender = ?,
-                    {current_prefix}height = ?,
-                    {current_prefix}weight = ?,
-                    {current_prefix}a1c = ?,
-                    {current_prefix}bloodPressure = ?,
-                    {current_prefix}medicine = ?,
-                    {current_prefix}tokens = ?
-                WHERE email = ?
-                """,
-                (
-                    row[next_prefix + "firstName"],
-                    row[next_prefix + "lastName"],
-                    row[next_prefix + "dob"],
-                    row[next_prefix + "race"],
-                    row[next_prefix + "gender"],
-                    row[next_prefix + "height"],
-                    row[next_prefix + "weight"],
-                    row[next_prefix + "a1c"],
-                    row[next_prefix + "bloodPressure"],
-                    row[next_prefix + "medicine"],
-                    row[next_prefix + "tokens"],
-                    email
-                )
-            )
-        
-        # Clear the last member slot (member4)
-        conn.execute(
-            """
-            UPDATE family_members SET
-                member4_firstName = NULL,
-                member4_lastName = NULL,
-                member4_dob = NULL,
-                member4_race = NULL,
-                member4_gender = NULL,
-                member4_height = NULL,
-                member4_weight = NULL,
-                member4_a1c = NULL,
-                member4_bloodPressure = NULL,
-                member4_medicine = NULL,
-                member4_tokens = 0
-            WHERE email = ?
-            """,
-            (email,)
-        )
+
+        # Shift members up after the deleted member, lowest first so no two
+        # rows share a slot at any point (the slot index is unique)
+        later = conn.execute(
+            "SELECT id FROM members WHERE email = ? AND member_index > ? ORDER BY member_index",
+            (email, member_index)
+        ).fetchall()
+        for row in later:
+            conn.execute("UPDATE members SET member_index = member_index - 1 WHERE id = ?", (row["id"],))
         conn.commit()
-        
+        member_profile_cache.invalidate(email)
+
         return {
             "message": f"Member {member_index} deleted successfully and members shifted",
             "deleted_member_index": member_index,
             "email": email
         }
-        
+
     except sqlite3.Error as e:
         logging.error(f"Database error during member deletion: {e}")
         raise HTTPException(status_code=500, detail="Database error occurred")
     finally:
         conn.close()
 
+#<<<<<<<<<<<<<<<<<AI ANSWER CACHE>>>>>>>>>>>>>>>>>>>
+
+AI_CACHE_TTL_SECONDS = float(os.getenv("AI_CACHE_TTL_SECONDS", "86400"))
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "5000"))
+
+ai_cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+def normalize_prompt(prompt_text: str) -> str:
+    return " ".join(prompt_text.split()).casefold()
+
+def ai_cache_key(prompt_text: str, provider: str, model: Optional[str]) -> str:
+    raw = f"{provider}\x00{model or ''}\x00{normalize_prompt(prompt_text)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def member_cache_name(member_data: Optional[str]) -> Optional[str]:
+    """Chat-file style `firstName_lastName` tag used to invalidate a member's answers"""
+    if not member_data or member_data == "undefined":
+        return None
+    try:
+        member = json.loads(member_data)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(member, dict):
+        return None
+    return f"{member.get('firstName', '')}_{member.get('lastName', '')}"
+
+def is_cacheable_answer(answer) -> bool:
+    # Provider failures raise ProviderError, so any non-empty answer is real
+    return isinstance(answer, str) and bool(answer.strip())
+
+def get_cached_answer(cache_key: str) -> Optional[str]:
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT answer, created_at FROM ai_answer_cache WHERE cache_key = ?",
+            (cache_key,)
+        ).fetchone()
+        if row is None or now - row["created_at"] > AI_CACHE_TTL_SECONDS:
+            if row is not None:
+                conn.execute("DELETE FROM ai_answer_cache WHERE cache_key = ?", (cache_key,))
+                conn.commit()
+            ai_cache_stats["misses"] += 1
+            return None
+        conn.execute("UPDATE ai_answer_cache SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+        conn.commit()
+        ai_cache_stats["hits"] += 1
+        return row["answer"]
+    finally:
+        conn.close()
+
+def store_cached_answer(cache_key: str, answer: str, provider: str, model: Optional[str],
+                        email: Optional[str] = None, member_name: Optional[str] = None):
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO ai_answer_cache
+                (cache_key, email, member_name, provider, model, answer, created_at, last_access)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (cache_key, email, member_name, provider, model, answer, now, now)
+        )
+        conn.execute("DELETE FROM ai_answer_cache WHERE created_at < ?", (now - AI_CACHE_TTL_SECONDS,))
+        # Size bound: drop the least recently used entries beyond the cap
+        cursor = conn.execute(
+            """
+            DELETE FROM ai_answer_cache WHERE cache_key IN (
+                SELECT cache_key FROM ai_answer_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (AI_CACHE_MAX_ENTRIES,)
+        )
+        ai_cache_stats["evictions"] += max(cursor.rowcount, 0)
+        conn.commit()
+        ai_cache_stats["stores"] += 1
+    finally:
+        conn.close()
+
+def invalidate_member_answers(conn, email: str, member_names):
+    """Drop cached answers for a member; runs inside the caller's transaction"""
+    names = [name for name in member_names if name]
+    if not names:
+        return
+    placeholders = ", ".join("?" for _ in names)
+    cursor = conn.execute(
+        f"DELETE FROM ai_answer_cache WHERE email = ? AND member_name IN ({placeholders})",
+        (email, *names)
+    )
+    ai_cache_stats["invalidations"] += max(cursor.rowcount, 0)
+
+@app.get("/medlife/metrics/ai-cache")
+@runs_in_db_executor
+def ai_cache_metrics():
+    conn = get_db_connection()
+    try:
+        size = conn.execute("SELECT COUNT(*) FROM ai_answer_cache").fetchone()[0]
+    finally:
+        conn.close()
+    lookups = ai_cache_stats["hits"] + ai_cache_stats["misses"]
+    return {
+        **ai_cache_stats,
+        "size": size,
+        "max_entries": AI_CACHE_MAX_ENTRIES,
+        "ttl_seconds": AI_CACHE_TTL_SECONDS,
+        "hit_rate": round(ai_cache_stats["hits"] / lookups, 4) if lookups else 0.0,
+    }
+
+#<<<<<<<<<<<<<<<<<REQUEST COALESCING>>>>>>>>>>>>>>>>>>>
+
+# Identical concurrent ask_ai requests (double clicks, retries) share one
+# provider call. Keys are the cache's prompt/provider/model hash plus a hash of
+# the API key, so a call is only shared between requests using the same key:
+# each caller is billed to and rate limited on its own key, and never sees
+# another key's auth or quota errors.
+_inflight_requests: Dict[str, asyncio.Task] = {}
+singleflight_stats = {"leaders": 0, "collapsed": 0}
+
+def flight_key(cache_key: str, api_key: str) -> str:
+    return f"{cache_key}:{hashlib.sha256(api_key.encode()).hexdigest()}"
+
+async def singleflight(key: str, factory):
+    task = _inflight_requests.get(key)
+    if task is not None:
+        singleflight_stats["collapsed"] += 1
+    else:
+        task = asyncio.ensure_future(factory())
+        _inflight_requests[key] = task
+
+        def _forget(done_task, key=key):
+            if _inflight_requests.get(key) is done_task:
+                del _inflight_requests[key]
+
+        task.add_done_callback(_forget)
+        singleflight_stats["leaders"] += 1
+    # Shield so one waiter disconnecting does not cancel the call for the rest
+    return await asyncio.shield(task)
+
+@app.get("/medlife/metrics/singleflight")
+async def singleflight_metrics():
+    return {**singleflight_stats, "in_flight": len(_inflight_requests)}
+
 #<<<<<<<<<<<<<<<<<PROMPT FOR SIDE BAR>>>>>>>>>>>>>>>>>>>
 
 from typing import Optional
 
-@app.get("/medlife/ask_ai/")
-async def ask_ai(query: str, api_key: str, provider: str = "openai", email: Optional[str] = None, member_data: Optional[str] = None, fallback_provider: Optional[str] = None):
-    prompt_text = f"Act as an Healthcare AI assistant, answer health questions based on patient data. "
-    
-    if member_data and member_data != "undefined":
-        try:
-            member = json.loads(member_data)
-            prompt_text += f"\n\nPatient Details:\n"
-            prompt_text += f"Name: {member.get('firstName', '')} {member.get('lastName', '')}\n"
-            prompt_text += f"Date of Birth: {member.get('dob', '')}\n"
-            prompt_text += f"Gender: {member.get('gender', '')}\n"
-            prompt_text += f"Race: {member.get('race', '')}\n"
-            prompt_text += f"Height: {member.get('height', '')}\n"
-            prompt_text += f"Weight: {member.get('weight', '')}\n"
-            prompt_text += f"A1C Level: {member.get('a1c', '')}\n"
-            prompt_text += f"Blood Pressure: {member.get('bloodPressure', '')}\n"
-            prompt_text += f"Current Medications: {member.get('medicine', '')}\n"
-        except json.JSONDecodeError:
-            pass
+PROMPT_INTRO = "Act as an Healthcare AI assistant, answer health questions based on patient data. "
+
+def parse_member_data(member_data: Optional[str]) -> Optional[dict]:
+    if not member_data or member_data == "undefined":
+        return None
+    try:
+        member = json.loads(member_data)
+    except json.JSONDecodeError:
+        return None
+    return member if isinstance(member, dict) else None
+
+def patient_prompt_prefix(member: Optional[dict]) -> str:
+    """Everything before the conversation context and question; the same for every question about a member"""
+    prompt_text = PROMPT_INTRO
+
+    if member is not None:
+        prompt_text += f"\n\nPatient Details:\n"
+        prompt_text += f"Name: {member.get('firstName', '')} {member.get('lastName', '')}\n"
+        prompt_text += f"Date of Birth: {member.get('dob', '')}\n"
+        prompt_text += f"Gender: {member.get('gender', '')}\n"
+        prompt_text += f"Race: {member.get('race', '')}\n"
+        prompt_text += f"Height: {member.get('height', '')}\n"
+        prompt_text += f"Weight: {member.get('weight', '')}\n"
+        prompt_text += f"A1C Level: {member.get('a1c', '')}\n"
+        prompt_text += f"Blood Pressure: {member.get('bloodPressure', '')}\n"
+        prompt_text += f"Current Medications: {member.get('medicine', '')}\n"
+
+    return prompt_text
+
+def member_prompt_prefix(member: dict) -> str:
+    """Prefix for a member from the profile cache, built once per cached profile"""
+    prefix = member.get("promptPrefix")
+    if prefix is None:
+        prefix = member["promptPrefix"] = patient_prompt_prefix(member)
+    return prefix
+
+def prompt_tail(prompt_text: str, prefix: str) -> str:
+    """What follows the cacheable prefix: conversation context and the question"""
+    return prompt_text[len(prefix):].lstrip("\n")
+
+def assemble_ai_prompt(prefix: str, query: str, context: str = "") -> str:
+    prompt_text = prefix
+
+    if context:
+        prompt_text += f"\n\n{context}"
     
     prompt_text += f"\n\nQuestion: {query}"
+    return prompt_text
 
+async def build_ai_prompt_with_context(query: str, provider: str, model: str, email: Optional[str],
+                                       prefix: str, member_name: Optional[str], with_history: Optional[bool]) -> str:
+    prompt_text = assemble_ai_prompt(prefix, query)
+    if not (CHAT_CONTEXT_ENABLED if with_history is None else with_history):
+        return prompt_text
+    context = await conversation_context(email, member_name, provider, model, prompt_text)
+    return assemble_ai_prompt(prefix, query, context) if context else prompt_text
+
+async def answer_ai_question(query: str, api_key: str, provider: str, email: Optional[str], prefix: str,
+                             member_name: Optional[str], fallback_provider: Optional[str] = None,
+                             hedge: Optional[bool] = None, with_history: Optional[bool] = None):
     config = get_provider_config(provider)
     model = config["models"][0] if config and "models" in config else "gpt-3.5-turbo"
+
+    prompt_text = await build_ai_prompt_with_context(query, provider, model, email, prefix, member_name, with_history)
+
+    cache_key = ai_cache_key(prompt_text, provider, model)
+    cached_answer = await run_db(get_cached_answer, cache_key)
+    if cached_answer is not None:
+        return cached_answer
     
+    async def fetch_answer():
+        answer = await ask_provider(prompt_tail(prompt_text, prefix), api_key, provider, model,
+                                    fallback=fallback_provider, hedge=HEDGE_ENABLED if hedge is None else hedge,
+                                    prefix=prefix)
+        if is_cacheable_answer(answer):
+            await run_db(store_cached_answer, cache_key, answer, provider, model, email, member_name)
+        return answer
+
     try:
-        final_answer = ask_provider(prompt_text, api_key, provider, model, fallback=fallback_provider)
+        final_answer = await singleflight(flight_key(cache_key, api_key), fetch_answer)
         return final_answer
+    except ProviderError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/medlife/ask_ai/")
+async def ask_ai(query: str, api_key: str, provider: str = "openai", email: Optional[str] = None, member_data: Optional[str] = None, fallback_provider: Optional[str] = None, hedge: Optional[bool] = None, with_history: bool = False):
+    prefix = patient_prompt_prefix(parse_member_data(member_data))
+    return await answer_ai_question(query, api_key, provider, email, prefix, member_cache_name(member_data),
+                                    fallback_provider, hedge, with_history)
+
+class AskAIRequest(BaseModel):
+    email: str
+    member_index: int
+    query: str
+    api_key: str
+    provider: str = "openai"
+    fallback_provider: Optional[str] = None
+    hedge: Optional[bool] = None
+    with_history: Optional[bool] = None
+
+@app.post("/medlife/ask_ai/")
+async def ask_ai_for_member(body: AskAIRequest):
+    """
+    ask_ai for a stored member: the patient details come from the member
+    profile cache instead of a member_data JSON query parameter
+    """
+    return await ask_stored_member(body.email, body.member_index, body.query, body.api_key, body.provider,
+                                   body.fallback_provider, body.hedge, body.with_history)
+
+async def fetch_stored_member(email: str, member_index: int) -> dict:
+    profile = await run_db(get_member_profile, email)
+    member = find_profile_member(profile, member_index=member_index)
+    if member is None:
+        raise HTTPException(status_code=404, detail=f"Member {member_index} not found")
+    return member
+
+async def ask_stored_member(email: str, member_index: int, query: str, api_key: str, provider: str = "openai",
+                            fallback_provider: Optional[str] = None, hedge: Optional[bool] = None,
+                            with_history: Optional[bool] = None):
+    member = await fetch_stored_member(email, member_index)
+    return await answer_ai_question(query, api_key, provider, email,
+                                    member_prompt_prefix(member), f"{member['firstName']}_{member['lastName']}",
+                                    fallback_provider, hedge, with_history)
+
+#<<<<<<<<<<<<<<<<<STREAMING PROMPT FOR SIDE BAR>>>>>>>>>>>>>>>>>>>
+from fastapi.responses import StreamingResponse
+
+async def open_answer_stream(prompt_text: str, prefix: str, api_key: str, provider: str, model: str):
+    """
+    Start streaming an answer once the circuit breaker and rate limiter let
+    the call through. The caller reports the outcome to the returned breaker.
+    """
+    try:
+        chunks = stream_provider(prompt_tail(prompt_text, prefix), api_key, provider, model, prefix)
+        breaker = get_circuit_breaker(provider)
+        breaker.before_call()
+    except ProviderError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    try:
+        await acquire_rate_limit(provider, api_key, prompt_text)
+    except ProviderError as e:
+        breaker.release()
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return chunks, breaker
+
+def stream_failure(e: Exception):
+    """(trips the breaker, HTTP status) for an error raised mid-stream"""
+    if isinstance(e, ProviderError):
+        return e.trips_breaker, e.status_code
+    if isinstance(e, httpx.HTTPError):
+        return True, 503
+    return False, 400
+
+@app.get("/medlife/ask_ai/stream/")
+async def ask_ai_stream(query: str, api_key: str, provider: str = "openai", email: Optional[str] = None, member_data: Optional[str] = None, with_history: bool = False):
+    """
+    Server-sent events variant of ask_ai. Every event carries the same chunk
+    shape for all providers: {"provider", "model", "index", "delta", "done"}.
+    A provider failure ends the stream with an `error` event.
+    """
+    if not api_key:
+        raise HTTPException(status_code=400, detail="API key is required")
+
+    config = get_provider_config(provider)
+    model = config["models"][0] if config and "models" in config else "gpt-3.5-turbo"
+    prefix = patient_prompt_prefix(parse_member_data(member_data))
+    prompt_text = await build_ai_prompt_with_context(query, provider, model, email, prefix,
+                                                     member_cache_name(member_data), with_history)
+    chunks, breaker = await open_answer_stream(prompt_text, prefix, api_key, provider, model)
+
+    async def event_stream():
+        index = 0
+        failed = None  # stays None if the client goes away mid-stream
+        try:
+            async for delta in chunks:
+                yield sse_event({"provider": provider, "model": model, "index": index, "delta": delta, "done": False})
+                index += 1
+            failed = False
+            yield sse_event({"provider": provider, "model": model, "index": index, "delta": "", "done": True})
+        except (ProviderError, ValueError, httpx.HTTPError) as e:
+            failed, status = stream_failure(e)
+            logging.error(f"Streaming error from {provider}: {e}")
+            yield sse_event({"provider": provider, "model": model, "index": index, "error": str(e), "status": status, "done": True}, event="error")
+        finally:
+            if failed is None:
+                breaker.release()
+            else:
+                breaker.record_result(failed=failed)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+#<<<<<<<<<<<<<<<<<BATCH ASK>>>>>>>>>>>>>>>>>>>
+
+# Several questions, e.g. the same one for every family member, in one
+# request. Items run concurrently, at most BATCH_ASK_CONCURRENCY at a time,
+# and each result is written as an NDJSON line as soon as it completes.
+# Question tokens for all items are booked up front in one transaction, so a
+# batch that would cross a member's limit is rejected before anything runs.
+BATCH_ASK_CONCURRENCY = int(os.getenv("BATCH_ASK_CONCURRENCY", "4"))
+BATCH_ASK_MAX_ITEMS = int(os.getenv("BATCH_ASK_MAX_ITEMS", "20"))
+
+class BatchAskItem(BaseModel):
+    member_index: int
+    question: str
+    provider: str = "openai"
+
+class BatchAskRequest(BaseModel):
+    email: str
+    items: List[BatchAskItem]
+    api_keys: Dict[str, str]  # provider -> API key
+    fallback_provider: Optional[str] = None
+
+@app.post("/medlife/ask_ai/batch/")
+async def ask_ai_batch(body: BatchAskRequest):
+    if not body.items:
+        raise HTTPException(status_code=400, detail="No questions to ask")
+    if len(body.items) > BATCH_ASK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_ASK_MAX_ITEMS} questions per batch")
+
+    profile = await run_db(get_member_profile, body.email)
+    if not profile["exists"]:
+        raise HTTPException(status_code=404, detail="User not found")
+    members = []
+    for item in body.items:
+        member = find_profile_member(profile, member_index=item.member_index)
+        if member is None:
+            raise HTTPException(status_code=404, detail=f"Member {item.member_index} not found")
+        # Rejected here, before booking, so no token is charged for a question that cannot run
+        if item.provider not in AI_PROVIDERS:
+            raise HTTPException(status_code=400, detail=f"Unsupported provider: {item.provider}")
+        if not body.api_keys.get(item.provider):
+            raise HTTPException(status_code=400, detail=f"API key for {item.provider} is required")
+        members.append(member)
+
+    counts: Dict[str, int] = {}
+    for member in members:
+        counts[member["firstName"]] = counts.get(member["firstName"], 0) + 1
+
+    def book():
+        conn = get_db_connection()
+        try:
+            return book_question_tokens(conn, body.email, counts)
+        finally:
+            conn.close()
+
+    booked = await run_db(book)
+
+    semaphore = asyncio.Semaphore(BATCH_ASK_CONCURRENCY)
+
+    async def run_item(index: int, item: BatchAskItem, member: dict) -> dict:
+        result = {"index": index, "member_index": item.member_index, "provider": item.provider,
+                  "tokens": booked[member["firstName"]]}
+        async with semaphore:
+            try:
+                result["answer"] = await answer_ai_question(
+                    item.question, body.api_keys[item.provider], item.provider, body.email,
+                    member_prompt_prefix(member), f"{member['firstName']}_{member['lastName']}",
+                    body.fallback_provider
+                )
+            except HTTPException as e:
+                result.update(error=e.detail, status=e.status_code)
+            except Exception as e:
+                # One failed item must not end the stream for the others
+                logging.exception(f"Batch item {index} for {body.email} failed")
+                result.update(error=f"Unexpected error: {e}", status=500)
+        return result
+
+    tasks = [asyncio.ensure_future(run_item(i, item, member)) for i, (item, member) in enumerate(zip(body.items, members))]
+
+    async def results():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            # Client went away: stop the questions still waiting or running
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+#<<<<<<<<<<<<<<<<<AI JOB QUEUE>>>>>>>>>>>>>>>>>>>
+
+# Job mode for ask_ai: submitting stores the request in the ai_jobs table and
+# returns a job id at once, so no HTTP request has to outlive a proxy timeout.
+# JOB_WORKERS async workers claim queued jobs one at a time and run them
+# within each job's deadline. Clients poll GET /medlife/jobs/{id}, optionally
+# long-polling with `wait`. Queued jobs survive a restart; jobs that were
+# running when the process died are queued again on startup, which assumes a
+# single app process per database. A job whose final write failed stays
+# 'running'; the maintenance sweep queues it again once it is JOB_LEASE_SECONDS
+# past its deadline, and the worker then records it as expired.
+#
+# The API key never sits in users.db in a form the database alone can open.
+# With JOB_KEY_SECRET set it is stored Fernet-encrypted under a key derived
+# from that secret, and cleared when the job finishes. Without it the key is
+# only kept in memory, so jobs still pending at a restart fail and have to be
+# submitted again.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_DEFAULT_DEADLINE_SECONDS = float(os.getenv("JOB_DEFAULT_DEADLINE_SECONDS", "300"))
+JOB_MAX_DEADLINE_SECONDS = 3600
+JOB_POLL_SECONDS = 5.0
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_HOURS", "24")) * 3600
+JOB_MAX_WAIT_SECONDS = 25
+JOB_LEASE_SECONDS = 60
+JOB_FINISH_ATTEMPTS = 3
+JOB_KEY_SECRET = os.getenv("JOB_KEY_SECRET")
+
+job_wakeup = asyncio.Event()
+_job_waiters: Dict[str, asyncio.Event] = {}
+_job_api_keys: Dict[str, str] = {}  # job id -> API key, when JOB_KEY_SECRET is unset
+job_stats = {"submitted": 0, "done": 0, "failed": 0, "expired": 0}
+
+class AskAIJobRequest(AskAIRequest):
+    deadline_seconds: Optional[float] = None
+
+def job_key_cipher(email: str) -> Fernet:
+    digest = hashlib.sha256(f"{JOB_KEY_SECRET}\0{email}".encode()).digest()
+    return Fernet(base64.urlsafe_b64encode(digest))
+
+def seal_job_api_key(job_id: str, email: str, api_key: str) -> Optional[str]:
+    """The value for ai_jobs.api_key; None keeps the key in memory only"""
+    if not JOB_KEY_SECRET:
+        _job_api_keys[job_id] = api_key
+        return None
+    return job_key_cipher(email).encrypt(api_key.encode()).decode()
+
+def open_job_api_key(row) -> Optional[str]:
+    if row["api_key"] is None:
+        return _job_api_keys.get(row["id"])
+    if not JOB_KEY_SECRET:
+        return None
+    try:
+        return job_key_cipher(row["email"]).decrypt(row["api_key"].encode()).decode()
+    except InvalidToken:
+        # JOB_KEY_SECRET changed since the job was submitted
+        return None
+
+def insert_job(job_id: str, body: AskAIJobRequest, deadline_at: float):
+    request = {
+        "member_index": body.member_index,
+        "query": body.query,
+        "provider": body.provider,
+        "fallback_provider": body.fallback_provider,
+        "hedge": body.hedge,
+        "with_history": body.with_history,
+    }
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            """
+            INSERT INTO ai_jobs (id, email, status, request, api_key, created_at, deadline_at)
+            VALUES (?, ?, 'queued', ?, ?, ?, ?)
+            """,
+            (job_id, body.email, json.dumps(request), seal_job_api_key(job_id, body.email, body.api_key),
+             time.time(), deadline_at)
+        )
+        conn.commit()
+    except sqlite3.Error:
+        _job_api_keys.pop(job_id, None)
+        raise
+    finally:
+        conn.close()
+
+def fetch_job(job_id: str):
+    conn = get_db_connection()
+    try:
+        return conn.execute("SELECT * FROM ai_jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+
+def claim_job():
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            """
+            UPDATE ai_jobs SET status = 'running', started_at = ?, attempts = attempts + 1
+            WHERE id = (SELECT id FROM ai_jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1)
+            RETURNING *
+            """,
+            (time.time(),)
+        ).fetchone()
+        conn.commit()
+        return row
+    finally:
+        conn.close()
+
+def finish_job(job_id: str, status: str, result=None, error: Optional[str] = None, status_code: int = 200):
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            """
+            UPDATE ai_jobs SET status = ?, result = ?, error = ?, status_code = ?, finished_at = ?, api_key = NULL
+            WHERE id = ?
+            """,
+            (status, None if result is None else json.dumps(result), error, status_code, time.time(), job_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    job_stats[status] += 1
+
+def requeue_interrupted_jobs():
+    conn = get_db_connection()
+    try:
+        # Keys that were only held in memory are gone
+        lost = conn.execute(
+            """
+            UPDATE ai_jobs SET status = 'failed', error = 'The server restarted before this job ran; please submit it again',
+                               status_code = 410, finished_at = ?
+            WHERE status IN ('queued', 'running') AND api_key IS NULL
+            """,
+            (time.time(),)
+        ).rowcount
+        count = conn.execute("UPDATE ai_jobs SET status = 'queued' WHERE status = 'running'").rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if lost:
+        logging.warning(f"Failed {lost} AI jobs whose in-memory API key was lost in a restart")
+    if count:
+        logging.info(f"Re-queued {count} AI jobs interrupted by a restart")
+
+def requeue_stale_jobs() -> int:
+    """Queue 'running' jobs again once they are a lease past their deadline"""
+    conn = get_db_connection()
+    try:
+        count = conn.execute(
+            "UPDATE ai_jobs SET status = 'queued' WHERE status = 'running' AND deadline_at < ?",
+            (time.time() - JOB_LEASE_SECONDS,)
+        ).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if count:
+        logging.warning(f"Re-queued {count} AI jobs left running past their deadline")
+    return count
+
+def expire_and_prune_jobs() -> List[str]:
+    """Expire queued jobs past their deadline; returns their ids"""
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        expired = conn.execute(
+            """
+            UPDATE ai_jobs SET status = 'expired', error = 'Deadline exceeded', status_code = 504,
+                               finished_at = ?, api_key = NULL
+            WHERE status = 'queued' AND deadline_at <= ?
+            RETURNING id
+            """,
+            (now, now)
+        ).fetchall()
+        conn.execute("DELETE FROM ai_jobs WHERE finished_at < ?", (now - JOB_RETENTION_SECONDS,))
+        conn.commit()
+    finally:
+        conn.close()
+    job_stats["expired"] += len(expired)
+    return [row["id"] for row in expired]
+
+def release_job(job_id: str):
+    """Drop a finished job's in-memory state and wake anyone long-polling it"""
+    _job_api_keys.pop(job_id, None)
+    waiter = _job_waiters.pop(job_id, None)
+    if waiter is not None:
+        waiter.set()
+
+async def record_job_result(job_id: str, status: str, **fields):
+    """finish_job with a few retries; on failure the lease sweep picks the job up"""
+    for attempt in range(1, JOB_FINISH_ATTEMPTS + 1):
+        try:
+            await run_db(finish_job, job_id, status, **fields)
+            return
+        except sqlite3.Error as e:
+            logging.error(f"Could not record AI job {job_id} as {status} (attempt {attempt}): {e}")
+            if attempt < JOB_FINISH_ATTEMPTS:
+                await asyncio.sleep(0.5 * attempt)
+
+async def run_job(row):
+    request = json.loads(row["request"])
+    try:
+        remaining = row["deadline_at"] - time.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError
+        api_key = open_job_api_key(row)
+        if api_key is None:
+            raise HTTPException(status_code=410, detail="The API key for this job is no longer available; please submit it again")
+        answer = await asyncio.wait_for(
+            ask_stored_member(row["email"], request["member_index"], request["query"], api_key,
+                              request["provider"], request["fallback_provider"], request["hedge"],
+                              request["with_history"]),
+            timeout=remaining
+        )
+    except asyncio.TimeoutError:
+        await record_job_result(row["id"], "expired", error="Deadline exceeded", status_code=504)
+    except HTTPException as e:
+        await record_job_result(row["id"], "failed", error=str(e.detail), status_code=e.status_code)
+    except Exception as e:
+        logging.exception(f"AI job {row['id']} crashed")
+        await record_job_result(row["id"], "failed", error=str(e), status_code=500)
+    else:
+        await record_job_result(row["id"], "done", result=answer)
+    finally:
+        release_job(row["id"])
+
+async def run_job_worker():
+    while True:
+        job_wakeup.clear()
+        try:
+            row = await run_db(claim_job)
+        except Exception:
+            logging.exception("Could not claim an AI job")
+            row = None
+        if row is None:
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await run_job(row)
+        except Exception:
+            # Never let one job take the worker down with it
+            logging.exception(f"AI job worker failed on job {row['id']}")
+
+async def run_job_maintenance():
+    while True:
+        try:
+            for job_id in await run_db(expire_and_prune_jobs):
+                release_job(job_id)
+            if await run_db(requeue_stale_jobs):
+                job_wakeup.set()
+        except Exception:
+            logging.exception("AI job maintenance failed")
+        await asyncio.sleep(60)
+
+@app.on_event("startup")
+async def start_job_workers():
+    if JOB_WORKERS <= 0:
+        return
+    await run_db(requeue_interrupted_jobs)
+    for _ in range(JOB_WORKERS):
+        asyncio.create_task(run_job_worker())
+    asyncio.create_task(run_job_maintenance())
+
+def job_view(row) -> dict:
+    view = {
+        "job_id": row["id"],
+        "status": row["status"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+        "deadline_at": row["deadline_at"],
+    }
+    if row["status"] == "done":
+        view["answer"] = json.loads(row["result"])
+    elif row["status"] in ("failed", "expired"):
+        view["error"] = row["error"]
+        view["status_code"] = row["status_code"]
+    return view
+
+@app.post("/medlife/jobs/ask_ai/", status_code=202)
+async def submit_ask_ai_job(body: AskAIJobRequest):
+    deadline = body.deadline_seconds or JOB_DEFAULT_DEADLINE_SECONDS
+    if deadline <= 0 or deadline > JOB_MAX_DEADLINE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"deadline_seconds must be between 0 and {JOB_MAX_DEADLINE_SECONDS}")
+    job_id = secrets.token_urlsafe(16)
+    await run_db(insert_job, job_id, body, time.time() + deadline)
+    job_stats["submitted"] += 1
+    job_wakeup.set()
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/medlife/jobs/{job_id}")
+async def get_ask_ai_job(job_id: str, email: str, wait: float = Query(0, ge=0, le=JOB_MAX_WAIT_SECONDS)):
+    """
+    Job status, with the answer once done. `wait` long-polls up to that many
+    seconds for an unfinished job to finish.
+    """
+    row = await run_db(fetch_job, job_id)
+    if row is None or row["email"] != email:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if wait and row["status"] in ("queued", "running"):
+        waiter = _job_waiters.setdefault(job_id, asyncio.Event())
+        # Re-read so a job that finished in between does not wait out the timeout
+        row = await run_db(fetch_job, job_id)
+        if row["status"] in ("queued", "running"):
+            try:
+                await asyncio.wait_for(waiter.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            row = await run_db(fetch_job, job_id)
+        elif _job_waiters.get(job_id) is waiter:
+            # Finished before the waiter was registered, so nothing will pop it
+            release_job(job_id)
+    return job_view(row)
+
+@app.get("/medlife/metrics/jobs")
+@runs_in_db_executor
+def job_metrics():
+    conn = get_db_connection()
+    try:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM ai_jobs GROUP BY status").fetchall())
+    finally:
+        conn.close()
+    return {"workers": JOB_WORKERS, "by_status": counts, **job_stats}
 
 #<<<<<<<<<<<<<<<<<PROMPT FOR CHAT>>>>>>>>>>>>>>>>>>
 @app.get("/medlife/prompt/")
@@ -1046,115 +2845,305 @@ async def prompt(query: str, api_key: str):
         raise HTTPException(status_code=400, detail="OpenAI API key is required")
     
     try:
-        final_answer = ask_openai(f"Act as an Healthcare AI assistant, that means you can answer only health related question, given data contains patient details and patient's question, here it is :--- {query} ", api_key)
+        final_answer = await ask_openai(f"Act as an Healthcare AI assistant, that means you can answer only health related question, given data contains patient details and patient's question, here it is :--- {query} ", api_key)
         return final_answer
+    except ProviderError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 #<<<<<<<<<<<<<<<<<ADD TOKEN>>>>>>>>>>>>>>>>>>
-@app.get("/medlife/tokens/")
-async def increment_tokens(email: str, member_name: str):
+
+# Each question costs one token, capped at QUESTION_LIMIT per member. In the
+# default "sqlite" mode that is one conditional UPDATE, so concurrent
+# questions can neither lose increments nor overshoot the cap. The optional
+# "memory" mode counts in-process under a lock and writes the counts back in
+# batches; it enforces the cap exactly but assumes a single app process.
+QUESTION_LIMIT = 100
+TOKEN_COUNTER_MODE = os.getenv("TOKEN_COUNTER_MODE", "sqlite")
+TOKEN_FLUSH_INTERVAL_SECONDS = float(os.getenv("TOKEN_FLUSH_INTERVAL_SECONDS", "2"))
+TOKEN_FLUSH_BATCH = int(os.getenv("TOKEN_FLUSH_BATCH", "500"))
+
+def fetch_member_by_first_name(conn, email: str, first_name: str):
+    ensure_members_migrated(conn, email)
+    return conn.execute(
+        "SELECT id, tokens FROM members WHERE email = ? AND first_name = ? ORDER BY member_index LIMIT 1",
+        (email, first_name)
+    ).fetchone()
+
+class TokenCounters:
+    """Write-behind question counters used when TOKEN_COUNTER_MODE=memory"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[tuple, int] = {}     # (email, first name) -> members.id
+        self._emails: Dict[int, str] = {}    # members.id -> email
+        self._counts: Dict[int, int] = {}    # members.id -> tokens
+        self._dirty = set()
+        self.increments = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def _member_id(self, conn, email: str, first_name: str) -> Optional[int]:
+        member_id = self._ids.get((email, first_name))
+        if member_id is not None and member_id in self._counts:
+            return member_id
+        row = fetch_member_by_first_name(conn, email, first_name)
+        if row is None:
+            return None
+        self._ids[(email, first_name)] = row["id"]
+        self._emails[row["id"]] = email
+        self._counts.setdefault(row["id"], row["tokens"] or 0)
+        return row["id"]
+
+    def increment(self, conn, email: str, first_name: str) -> Optional[int]:
+        with self._lock:
+            member_id = self._member_id(conn, email, first_name)
+            if member_id is None:
+                return None
+            if self._counts[member_id] >= QUESTION_LIMIT:
+                raise HTTPException(status_code=400, detail="Question limit exceeded.")
+            self._counts[member_id] += 1
+            self._dirty.add(member_id)
+            self.increments += 1
+            return self._counts[member_id]
+
+    def increment_many(self, conn, email: str, counts: Dict[str, int]) -> Dict[str, int]:
+        """Book several members' questions at once, all or nothing"""
+        with self._lock:
+            member_ids = {}
+            for first_name, count in counts.items():
+                member_id = self._member_id(conn, email, first_name)
+                if member_id is None:
+                    raise HTTPException(status_code=404, detail="Member not found")
+                if self._counts[member_id] + count > QUESTION_LIMIT:
+                    raise HTTPException(status_code=400, detail="Question limit exceeded.")
+                member_ids[first_name] = member_id
+            for first_name, count in counts.items():
+                member_id = member_ids[first_name]
+                self._counts[member_id] += count
+                self._dirty.add(member_id)
+                self.increments += count
+            return {first_name: self._counts[member_id] for first_name, member_id in member_ids.items()}
+
+    def current(self, conn, email: str, first_name: str) -> Optional[int]:
+        with self._lock:
+            member_id = self._member_id(conn, email, first_name)
+            return None if member_id is None else self._counts[member_id]
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def flush(self, conn):
+        with self._lock:
+            batch = [(self._counts[member_id], member_id) for member_id in self._dirty]
+            self._dirty.clear()
+        if not batch:
+            return
+        try:
+            conn.executemany("UPDATE members SET tokens = ? WHERE id = ?", batch)
+            conn.commit()
+        except sqlite3.Error:
+            with self._lock:
+                self._dirty.update(member_id for _, member_id in batch)
+            raise
+        self.flushes += 1
+        self.flushed_rows += len(batch)
+
+    def detach_email(self, conn, email: str):
+        """
+        Write out and forget an account's counters before another endpoint
+        rewrites its members; runs inside the caller's transaction.
+        """
+        with self._lock:
+            member_ids = [member_id for member_id, owner in self._emails.items() if owner == email]
+            pending = [(self._counts[member_id], member_id) for member_id in member_ids if member_id in self._dirty]
+            for member_id in member_ids:
+                self._counts.pop(member_id, None)
+                self._emails.pop(member_id, None)
+                self._dirty.discard(member_id)
+            for key in [key for key in self._ids if key[0] == email]:
+                del self._ids[key]
+        if pending:
+            conn.executemany("UPDATE members SET tokens = ? WHERE id = ?", pending)
+
+token_counters = TokenCounters()
+
+def detach_token_counters(conn, email: str):
+    if TOKEN_COUNTER_MODE == "memory":
+        token_counters.detach_email(conn, email)
+
+def flush_token_counters():
     conn = get_db_connection()
     try:
-        cursor = conn.execute("SELECT * FROM family_members WHERE email = ?", (email,))
-        row = cursor.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="User not found")
-        # Find the member index by matching firstName and lastName
-        member_index = None
-        for i in range(1, 5):
-            prefix = f"member{i}_"
-            if row[prefix + "firstName"] == member_name:
-                member_index = i
-                break
-        if member_index is None:
-            raise HTTPException(status_code=404, detail="Member not found")
-        current_tokens = row[f"member{member_index}_tokens"] or 0
-        if current_tokens >= 100:
-            raise HTTPException(status_code=400, detail="Question limit exceeded.")
-        new_tokens = current_tokens + 1
-        conn.execute(
-            f"UPDATE family_members SET member{member_index}_tokens = ? WHERE email = ?",
-            (new_tokens, email)
-        )
-        conn.commit()
-        return {"message": str(new_tokens)}
+        token_counters.flush(conn)
     finally:
         conn.close()
 
-#<<<<<<<<<<<<<<<<<GET TOKEN COUNT>>>>>>>>>>>>>>>>>>
-@app.get("/medlife/tokensCount/")
-async def get_token_count(email: str, member_name: str):
+async def run_token_flusher():
+    while True:
+        await asyncio.sleep(TOKEN_FLUSH_INTERVAL_SECONDS)
+        try:
+            await run_db(flush_token_counters)
+        except sqlite3.Error as e:
+            logging.error(f"Token flush failed, will retry: {e}")
+
+@app.on_event("startup")
+async def start_token_flusher():
+    if TOKEN_COUNTER_MODE == "memory":
+        asyncio.create_task(run_token_flusher())
+
+@app.on_event("shutdown")
+def final_token_flush():
+    if TOKEN_COUNTER_MODE == "memory":
+        flush_token_counters()
+
+def increment_member_tokens(conn, email: str, first_name: str) -> Optional[int]:
+    """Book one question; returns the new count, or None if the member does not exist"""
+    if TOKEN_COUNTER_MODE == "memory":
+        tokens = token_counters.increment(conn, email, first_name)
+        if token_counters.pending() >= TOKEN_FLUSH_BATCH:
+            token_counters.flush(conn)
+        if tokens is not None:
+            member_profile_cache.set_tokens(email, first_name, tokens)
+        return tokens
+    ensure_members_migrated(conn, email)
+    rows = conn.execute(
+        """
+        UPDATE members SET tokens = tokens + 1
+        WHERE id = (
+            SELECT id FROM members WHERE email = ? AND first_name = ? ORDER BY member_index LIMIT 1
+        ) AND tokens < ?
+        RETURNING tokens
+        """,
+        (email, first_name, QUESTION_LIMIT)
+    ).fetchall()
+    conn.commit()
+    if rows:
+        member_profile_cache.set_tokens(email, first_name, rows[0]["tokens"])
+        return rows[0]["tokens"]
+    # Nothing updated: either the member is missing or already at the cap
+    if fetch_member_by_first_name(conn, email, first_name) is None:
+        return None
+    raise HTTPException(status_code=400, detail="Question limit exceeded.")
+
+def book_question_tokens(conn, email: str, counts: Dict[str, int]) -> Dict[str, int]:
+    """Book questions for several members in one transaction, all or nothing;
+    returns each member's new count"""
+    if TOKEN_COUNTER_MODE == "memory":
+        booked = token_counters.increment_many(conn, email, counts)
+    else:
+        ensure_members_migrated(conn, email)
+        conn.execute("BEGIN IMMEDIATE")
+        booked = {}
+        try:
+            for first_name, count in counts.items():
+                rows = conn.execute(
+                    """
+                    UPDATE members SET tokens = tokens + ?
+                    WHERE id = (
+                        SELECT id FROM members WHERE email = ? AND first_name = ? ORDER BY member_index LIMIT 1
+                    ) AND tokens + ? <= ?
+                    RETURNING tokens
+                    """,
+                    (count, email, first_name, count, QUESTION_LIMIT)
+                ).fetchall()
+                if not rows:
+                    if fetch_member_by_first_name(conn, email, first_name) is None:
+                        raise HTTPException(status_code=404, detail="Member not found")
+                    raise HTTPException(status_code=400, detail="Question limit exceeded.")
+                booked[first_name] = rows[0]["tokens"]
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    for first_name, tokens in booked.items():
+        member_profile_cache.set_tokens(email, first_name, tokens)
+    return booked
+
+@app.get("/medlife/tokens/")
+@runs_in_db_executor
+def increment_tokens(email: str, member_name: str):
     conn = get_db_connection()
     try:
-        cursor = conn.execute("SELECT * FROM family_members WHERE email = ?", (email,))
-        row = cursor.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="User not found")
-        member_index = None
-        for i in range(1, 5):
-            prefix = f"member{i}_"
-            if row[prefix + "firstName"] == member_name:
-                member_index = i
-                break
-        if member_index is None:
+        new_tokens = increment_member_tokens(conn, email, member_name)
+        if new_tokens is None:
+            if not account_exists(conn, email):
+                raise HTTPException(status_code=404, detail="User not found")
             raise HTTPException(status_code=404, detail="Member not found")
-        tokens = row[f"member{member_index}_tokens"] or 0
-        return {"message": str(tokens)}
+        return {"message": str(new_tokens)}
     finally:
         conn.close()
 
+@app.get("/medlife/metrics/tokens")
+async def token_metrics():
+    return {
+        "mode": TOKEN_COUNTER_MODE,
+        "limit": QUESTION_LIMIT,
+        "pending_writes": token_counters.pending(),
+        "increments": token_counters.increments,
+        "flushes": token_counters.flushes,
+        "flushed_rows": token_counters.flushed_rows,
+    }
+
+#<<<<<<<<<<<<<<<<<GET TOKEN COUNT>>>>>>>>>>>>>>>>>>
+@app.get("/medlife/tokensCount/")
+@runs_in_db_executor
+def get_token_count(email: str, member_name: str):
+    profile = get_member_profile(email)
+    if not profile["exists"]:
+        raise HTTPException(status_code=404, detail="User not found")
+    if TOKEN_COUNTER_MODE == "memory":
+        conn = get_db_connection()
+        try:
+            tokens = token_counters.current(conn, email, member_name)
+        finally:
+            conn.close()
+    else:
+        member = find_profile_member(profile, first_name=member_name)
+        tokens = None if member is None else member["tokens"]
+    if tokens is None:
+        raise HTTPException(status_code=404, detail="Member not found")
+    return {"message": str(tokens)}
+
 @app.get("/api/member-details/{email}/{member_index}")
-async def get_member_details(email: str, member_index: int):
+@runs_in_db_executor
+def get_member_details(email: str, member_index: int):
     """
     Fetch complete details for a specific family member
     """
     if member_index < 1 or member_index > 4:
         raise HTTPException(status_code=400, detail="Invalid member index. Must be between 1 and 4")
-    
-    conn = get_db_connection()
+
     try:
-        cursor = conn.execute(
-            "SELECT * FROM family_members WHERE email = ?", 
-            (email,)
-        )
-        row = cursor.fetchone()
-        
-        if not row:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        prefix = f"member{member_index}_"
-        if not row[prefix + "firstName"]:
-            raise HTTPException(status_code=404, detail=f"Member {member_index} not found")
-        
-        member_details = {
-            "memberIndex": member_index,
-            "firstName": row[prefix + "firstName"],
-            "lastName": row[prefix + "lastName"],
-            "dob": row[prefix + "dob"],
-            "race": row[prefix + "race"],
-            "gender": row[prefix + "gender"],
-            "height": row[prefix + "height"],
-            "weight": row[prefix + "weight"],
-            "a1c": row[prefix + "a1c"],
-            "bloodPressure": row[prefix + "bloodPressure"],
-            "medicine": row[prefix + "medicine"],
-            "tokens": row[prefix + "tokens"] or 0,
-            "fullName": f"{row[prefix + 'firstName']} {row[prefix + 'lastName']}"
-        }
-        
-        return {"member": member_details}
-        
+        profile = get_member_profile(email)
     except sqlite3.Error as e:
         logging.error(f"Database error fetching member details: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+
+    if not profile["exists"]:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    member = find_profile_member(profile, member_index=member_index)
+    if member is None:
+        raise HTTPException(status_code=404, detail=f"Member {member_index} not found")
+
+    member_details = {
+        "memberIndex": member_index,
+        **{field: member[field] for field in MEMBER_COLUMNS},
+        "fullName": f"{member['firstName']} {member['lastName']}"
+    }
+
+    return {"member": member_details}
 
 #<<<<<<<<<<<<<<<<<<<<<<<<<<<<CHAT AREA>>>>>>>>>>>>>>>>>>>>>>>>>>>
 
 import json
 import os
+import aiofiles
+import aiofiles.os
+import struct
+import zlib
 from typing import List, Dict, Any
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -1163,30 +3152,529 @@ CHAT_DATA_DIR = os.path.join(BASE_DIR, 'chat_data')
 if not os.path.exists(CHAT_DATA_DIR):
     os.makedirs(CHAT_DATA_DIR)
 
-def save_chat_data_to_file(email: str, member_name: str, chat_data: list):
-    file_name = f"{email}_{member_name}.json"
-    file_path = os.path.join(CHAT_DATA_DIR, file_name)
+# Each member's history is an append-only JSONL log, one message per line.
+# Saves append only messages newer than the last stored id; anything that has
+# to replace the file is written to a temp file and renamed over it. Older
+# histories stored as a single JSON array are still read and are converted to
+# a log on their next save. File I/O goes through aiofiles so the event loop
+# never waits on the disk, and writes for one member serialize on chat_lock().
+_chat_locks: Dict[str, asyncio.Lock] = {}
+CHAT_COLD_SUFFIX = ".jsonl.cold"
+# Highest message id stored per log, so a save does not have to re-read it
+_chat_last_ids: Dict[str, Optional[int]] = {}
+
+def chat_base_path(email: str, member_name: str) -> str:
+    return os.path.join(CHAT_DATA_DIR, f"{email}_{member_name}")
+
+def chat_log_path(email: str, member_name: str) -> str:
+    return chat_base_path(email, member_name) + ".jsonl"
+
+def legacy_chat_path(email: str, member_name: str) -> str:
+    return chat_base_path(email, member_name) + ".json"
+
+def cold_chat_path(email: str, member_name: str) -> str:
+    return chat_base_path(email, member_name) + CHAT_COLD_SUFFIX
+
+def chat_path_lock(base_path: str) -> asyncio.Lock:
+    # Keyed by path so jobs that only see file names can take the same lock
+    lock = _chat_locks.get(base_path)
+    if lock is None:
+        lock = _chat_locks[base_path] = asyncio.Lock()
+    return lock
+
+def chat_lock(email: str, member_name: str) -> asyncio.Lock:
+    return chat_path_lock(chat_base_path(email, member_name))
+
+def message_id(message) -> Optional[int]:
+    value = message.get("id") if isinstance(message, dict) else None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return int(value)
+
+def last_message_id(messages: list) -> Optional[int]:
+    ids = [i for i in map(message_id, messages) if i is not None]
+    return max(ids) if ids else None
+
+def encode_chat_lines(messages: list) -> str:
+    return "".join(json.dumps(message) + "\n" for message in messages)
+
+def parse_chat_lines(path: str, lines) -> list:
+    messages = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            messages.append(json.loads(line))
+        except json.JSONDecodeError:
+            # Only a crash in the middle of an append can leave a torn line
+            logging.warning(f"Skipping unreadable line in {path}")
+    return messages
+
+async def read_chat_log(path: str) -> list:
+    async with aiofiles.open(path, 'r') as file:
+        text = await file.read()
+    return parse_chat_lines(path, text.splitlines())
+
+async def read_legacy_chat(path: str) -> list:
+    async with aiofiles.open(path, 'r') as file:
+        return json.loads(await file.read())
+
+async def write_file_atomic(path: str, data):
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    try:
+        async with aiofiles.open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as file:
+            await file.write(data)
+            await file.flush()
+            await asyncio.to_thread(os.fsync, file.fileno())
+        await aiofiles.os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            await aiofiles.os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+async def append_chat_lines(path: str, messages: list):
+    data = encode_chat_lines(messages).encode()
+    async with aiofiles.open(path, 'ab+') as file:
+        size = await file.seek(0, os.SEEK_END)
+        if size:
+            await file.seek(size - 1)
+            if await file.read(1) != b"\n":
+                # Start on a fresh line after a torn write
+                data = b"\n" + data
+        await file.write(data)
+        await file.flush()
+        await asyncio.to_thread(os.fsync, file.fileno())
 
-    with open(file_path, 'w') as file:
-        json.dump(chat_data, file)
+async def stored_last_id(email: str, member_name: str) -> Optional[int]:
+    """Last stored message id; converts a legacy JSON file to a log. Call with chat_lock held"""
+    path = chat_log_path(email, member_name)
+    if path in _chat_last_ids:
+        return _chat_last_ids[path]
+    legacy_path = legacy_chat_path(email, member_name)
+    cold_path = cold_chat_path(email, member_name)
+    if not await aiofiles.os.path.exists(path) and await aiofiles.os.path.exists(cold_path):
+        # Writing to a cold history promotes it back to a hot log
+        data = await read_cold_chat(cold_path)
+        await write_file_atomic(path, data)
+        await aiofiles.os.remove(cold_path)
+        messages = parse_chat_lines(path, data.decode().splitlines())
+        chat_tier_stats["promoted"] += 1
+    elif not await aiofiles.os.path.exists(path) and await aiofiles.os.path.exists(legacy_path):
+        messages = await read_legacy_chat(legacy_path)
+        await write_file_atomic(path, encode_chat_lines(messages))
+        await aiofiles.os.remove(legacy_path)
+    elif await aiofiles.os.path.exists(path):
+        messages = await read_chat_log(path)
+    else:
+        messages = []
+    _chat_last_ids[path] = last_message_id(messages)
+    return _chat_last_ids[path]
+
+async def append_chat_messages(email: str, member_name: str, messages: list, after_id: Optional[int] = None,
+                               assign_ids: bool = False) -> dict:
+    """Append the messages newer than the stored history. `after_id`, when given,
+    must match the last stored id so a client that missed a save can resync.
+    With `assign_ids` the messages are given ids after the stored history,
+    millisecond timestamps like the ones the frontend uses."""
+    path = chat_log_path(email, member_name)
+    async with chat_lock(email, member_name):
+        last_id = await stored_last_id(email, member_name)
+        if after_id is not None and after_id != last_id:
+            raise HTTPException(status_code=409, detail={"message": "Chat history changed", "last_id": last_id})
+        if assign_ids:
+            first_id = max(int(time.time() * 1000), (last_id or 0) + 1)
+            messages = [{**m, "id": first_id + i} for i, m in enumerate(messages)]
+        new_messages = [
+            m for m in messages
+            if last_id is None or (message_id(m) is not None and message_id(m) > last_id)
+        ]
+        if new_messages:
+            await append_chat_lines(path, new_messages)
+            _chat_last_ids[path] = max(last_id or 0, last_message_id(new_messages))
+            await run_db(index_chat_messages, email, member_name, new_messages)
+        result = {"appended": len(new_messages), "last_id": _chat_last_ids[path]}
+        if assign_ids:
+            result["messages"] = new_messages
+        return result
 
-def load_chat_data_from_file(email: str, member_name: str):
-    file_name = f"{email}_{member_name}.json"
-    file_path = os.path.join(CHAT_DATA_DIR, file_name)
+async def save_chat_data_to_file(email: str, member_name: str, chat_data: list):
+    path = chat_log_path(email, member_name)
+    async with chat_lock(email, member_name):
+        last_id = await stored_last_id(email, member_name)
+        ids = [message_id(m) for m in chat_data]
+        if last_id is not None and last_id in ids:
+            # The stored log is a prefix of what was sent
+            new_messages = chat_data[ids.index(last_id) + 1:]
+            if new_messages:
+                await append_chat_lines(path, new_messages)
+                await run_db(index_chat_messages, email, member_name, new_messages)
+        else:
+            await write_file_atomic(path, encode_chat_lines(chat_data))
+            await run_db(index_chat_messages, email, member_name, chat_data, replace=True)
+        _chat_last_ids[path] = last_message_id(chat_data) if chat_data else None
 
-    if not os.path.exists(file_path):
+async def load_chat_data_from_file(email: str, member_name: str):
+    path = chat_log_path(email, member_name)
+    if await aiofiles.os.path.exists(path):
+        started = time.perf_counter()
+        messages = await read_chat_log(path)
+        chat_tier_stats["hot_reads"] += 1
+        chat_tier_stats["hot_read_seconds"] += time.perf_counter() - started
+        return messages
+
+    cold_path = cold_chat_path(email, member_name)
+    if await aiofiles.os.path.exists(cold_path):
+        started = time.perf_counter()
+        data = await read_cold_chat(cold_path)
+        chat_tier_stats["cold_reads"] += 1
+        chat_tier_stats["cold_read_seconds"] += time.perf_counter() - started
+        return parse_chat_lines(cold_path, data.decode().splitlines())
+
+    legacy_path = legacy_chat_path(email, member_name)
+    if not await aiofiles.os.path.exists(legacy_path):
         return []
 
-    with open(file_path, 'r') as file:
-        chat_data = json.load(file)
-    
-    return chat_data
+    return await read_legacy_chat(legacy_path)
+
+#<<<<<<<<<<<<<<<<<CHAT TIERING>>>>>>>>>>>>>>>>>>>>
+
+# Histories idle for CHAT_COLD_AFTER_DAYS are compressed into a .jsonl.cold
+# file by a background job. Reads decompress them transparently and the next
+# write promotes them back to a hot log. zstd is used when the zstandard
+# package is installed, zlib (gzip's deflate) otherwise; both are primed with
+# a dictionary of text every chat repeats, which is most of a short history.
+CHAT_TIERING_ENABLED = os.getenv("CHAT_TIERING_ENABLED", "true").lower() == "true"
+CHAT_COLD_AFTER_DAYS = float(os.getenv("CHAT_COLD_AFTER_DAYS", "30"))
+CHAT_TIER_INTERVAL_SECONDS = float(os.getenv("CHAT_TIER_INTERVAL_SECONDS", "3600"))
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# Cold files record the dictionary version they were written with, so add a
+# new version rather than editing one
+CHAT_COMPRESSION_DICTS = {
+    1: (
+        b"consult your healthcare provider or doctor before making any changes to your medication. "
+        b"blood pressure, blood sugar, glucose levels, A1C, insulin, Metformin, diabetes, "
+        b"side effects, drug interactions, dosage, symptoms, diet, exercise, weight, patient "
+        b"<br><br>1. **<br>2. **<br>3. **<br>4. **: "
+        b'", "id": 17'
+        b'{"sender": "ai", "name": "Medlife.ai", "text": "\\"'
+        b'{"sender": "user", "name": "You", "text": "'
+    ),
+}
+CHAT_COMPRESSION_DICT_VERSION = 1
+COLD_MAGIC = b"MLC1"
+# magic, codec (s = zstd, z = zlib), dictionary version, uncompressed size
+COLD_HEADER = struct.Struct(">4scBQ")
+
+chat_tier_stats = {
+    "compressed": 0,
+    "promoted": 0,
+    "bytes_before": 0,
+    "bytes_after": 0,
+    "hot_reads": 0,
+    "hot_read_seconds": 0.0,
+    "cold_reads": 0,
+    "cold_read_seconds": 0.0,
+}
+
+def compress_chat(data: bytes) -> bytes:
+    zdict = CHAT_COMPRESSION_DICTS[CHAT_COMPRESSION_DICT_VERSION]
+    if ZSTD_AVAILABLE:
+        codec = b"s"
+        dict_data = zstandard.ZstdCompressionDict(zdict, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        body = zstandard.ZstdCompressor(level=10, dict_data=dict_data).compress(data)
+    else:
+        codec = b"z"
+        compressor = zlib.compressobj(9, zdict=zdict)
+        body = compressor.compress(data) + compressor.flush()
+    return COLD_HEADER.pack(COLD_MAGIC, codec, CHAT_COMPRESSION_DICT_VERSION, len(data)) + body
+
+def decompress_chat(blob: bytes) -> bytes:
+    magic, codec, version, size = COLD_HEADER.unpack_from(blob)
+    if magic != COLD_MAGIC:
+        raise ValueError("Not a cold chat file")
+    zdict = CHAT_COMPRESSION_DICTS[version]
+    body = blob[COLD_HEADER.size:]
+    if codec == b"s":
+        if not ZSTD_AVAILABLE:
+            raise RuntimeError("This chat history was compressed with zstd; install zstandard to read it")
+        dict_data = zstandard.ZstdCompressionDict(zdict, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(body, max_output_size=size)
+    decompressor = zlib.decompressobj(zdict=zdict)
+    return decompressor.decompress(body) + decompressor.flush()
+
+async def read_cold_chat(path: str) -> bytes:
+    async with aiofiles.open(path, 'rb') as file:
+        blob = await file.read()
+    return await asyncio.to_thread(decompress_chat, blob)
+
+async def compress_chat_file(base_path: str, cutoff: float) -> int:
+    """Move one idle history to the cold tier; returns the bytes saved"""
+    hot_path = base_path + ".jsonl"
+    legacy_path = base_path + ".json"
+    async with chat_path_lock(base_path):
+        if await aiofiles.os.path.exists(hot_path):
+            source = hot_path
+            async with aiofiles.open(hot_path, 'rb') as file:
+                data = await file.read()
+        elif await aiofiles.os.path.exists(legacy_path):
+            source = legacy_path
+            data = encode_chat_lines(await read_legacy_chat(legacy_path)).encode()
+        else:
+            return 0
+        st = await aiofiles.os.stat(source)
+        if st.st_mtime > cutoff:
+            # Written to since the scan
+            return 0
+        blob = await asyncio.to_thread(compress_chat, data)
+        await write_file_atomic(base_path + CHAT_COLD_SUFFIX, blob)
+        await aiofiles.os.remove(source)
+        # The next write must go through stored_last_id() to promote the file
+        _chat_last_ids.pop(hot_path, None)
+        _chat_indexes.pop(hot_path, None)
+    chat_tier_stats["compressed"] += 1
+    chat_tier_stats["bytes_before"] += st.st_size
+    chat_tier_stats["bytes_after"] += len(blob)
+    return st.st_size - len(blob)
+
+def idle_chat_files(cutoff: float) -> list:
+    base_paths = []
+    for entry in os.scandir(CHAT_DATA_DIR):
+        for suffix in (".jsonl", ".json"):
+            if entry.name.endswith(suffix) and entry.stat().st_mtime <= cutoff:
+                base_paths.append(entry.path[:-len(suffix)])
+    return base_paths
+
+async def tier_idle_chats() -> int:
+    cutoff = time.time() - CHAT_COLD_AFTER_DAYS * 86400
+    saved = 0
+    for base_path in await asyncio.to_thread(idle_chat_files, cutoff):
+        try:
+            saved += await compress_chat_file(base_path, cutoff)
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not move {base_path} to cold storage: {e}")
+    return saved
+
+async def run_chat_tiering():
+    while True:
+        try:
+            saved = await tier_idle_chats()
+            if saved:
+                logging.info(f"Chat tiering compressed idle histories, saved {saved} bytes")
+        except OSError as e:
+            logging.error(f"Chat tiering pass failed: {e}")
+        await asyncio.sleep(CHAT_TIER_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_chat_tiering():
+    if CHAT_TIERING_ENABLED:
+        asyncio.create_task(run_chat_tiering())
+
+def chat_tier_usage() -> dict:
+    usage = {"hot_files": 0, "hot_bytes": 0, "cold_files": 0, "cold_bytes": 0, "cold_original_bytes": 0}
+    for entry in os.scandir(CHAT_DATA_DIR):
+        if entry.name.endswith(CHAT_COLD_SUFFIX):
+            with open(entry.path, 'rb') as file:
+                header = file.read(COLD_HEADER.size)
+            usage["cold_files"] += 1
+            usage["cold_bytes"] += entry.stat().st_size
+            usage["cold_original_bytes"] += COLD_HEADER.unpack(header)[3]
+        elif entry.name.endswith((".jsonl", ".json")):
+            usage["hot_files"] += 1
+            usage["hot_bytes"] += entry.stat().st_size
+    usage["bytes_saved"] = usage["cold_original_bytes"] - usage["cold_bytes"]
+    return usage
+
+@app.get("/medlife/metrics/chat-tiering")
+async def chat_tiering_metrics():
+    stats = chat_tier_stats
+    return {
+        "enabled": CHAT_TIERING_ENABLED,
+        "codec": "zstd" if ZSTD_AVAILABLE else "zlib",
+        "cold_after_days": CHAT_COLD_AFTER_DAYS,
+        **await asyncio.to_thread(chat_tier_usage),
+        "compressed": stats["compressed"],
+        "promoted": stats["promoted"],
+        "avg_hot_read_ms": round(stats["hot_read_seconds"] / stats["hot_reads"] * 1000, 3) if stats["hot_reads"] else None,
+        "avg_cold_read_ms": round(stats["cold_read_seconds"] / stats["cold_reads"] * 1000, 3) if stats["cold_reads"] else None,
+    }
+
+#<<<<<<<<<<<<<<<<<CHAT PAGES>>>>>>>>>>>>>>>>>>>>
+
+# A page of history is read by seeking to the byte offsets of its lines, so
+# opening a long conversation costs about the same as a short one. The newest
+# page of a log with no index is read backwards from the end instead; the
+# index is only built once a client pages past it, and is extended from where
+# it stopped as the log grows. A log replaced by a rename has a new inode and
+# is re-indexed. At most CHAT_INDEX_MAX_ENTRIES indexes are kept, least
+# recently used first out.
+CHAT_PAGE_MAX = int(os.getenv("CHAT_PAGE_MAX", "200"))
+CHAT_INDEX_MAX_ENTRIES = int(os.getenv("CHAT_INDEX_MAX_ENTRIES", "256"))
+CHAT_TAIL_CHUNK = 64 * 1024
+
+class ChatOffsetIndex:
+    def __init__(self, inode: int):
+        self.inode = inode
+        self.size = 0  # bytes indexed, always at a line boundary
+        self.ids = []
+        self.offsets = []
+        self.positions = {}
+
+    async def extend(self, file):
+        await file.seek(self.size)
+        offset = self.size
+        for line in (await file.read()).splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                # Unfinished line; pick it up on the next extend
+                break
+            if line.strip():
+                try:
+                    mid = message_id(json.loads(line))
+                except json.JSONDecodeError:
+                    mid = False
+                if mid is not False:
+                    if mid is not None:
+                        self.positions[mid] = len(self.ids)
+                    self.ids.append(mid)
+                    self.offsets.append(offset)
+            offset += len(line)
+        self.size = offset
+
+    async def read(self, file, start: int, end: int) -> list:
+        if start >= end:
+            return []
+        await file.seek(self.offsets[start])
+        stop = self.offsets[end] if end < len(self.offsets) else self.size
+        data = await file.read(stop - self.offsets[start])
+        return parse_chat_lines(file.name, data.splitlines())
+
+_chat_indexes: "OrderedDict[str, ChatOffsetIndex]" = OrderedDict()
+
+def remember_chat_index(path: str, index: ChatOffsetIndex):
+    _chat_indexes[path] = index
+    _chat_indexes.move_to_end(path)
+    while len(_chat_indexes) > CHAT_INDEX_MAX_ENTRIES:
+        _chat_indexes.popitem(last=False)
+
+async def read_chat_tail(file, size: int, limit: int):
+    """The last `limit` messages of a log and whether older ones exist, reading only as far back as needed"""
+    pos, data = size, b""
+    # limit + 1 messages tell whether there is more; one extra newline
+    # because the first chunk read may start mid-line
+    want = limit + 2
+    while True:
+        while pos > 0 and data.count(b"\n") < want:
+            step = min(CHAT_TAIL_CHUNK, pos)
+            pos -= step
+            await file.seek(pos)
+            data = await file.read(step) + data
+        lines = data.splitlines(keepends=True)
+        if lines and not lines[-1].endswith(b"\n"):
+            # Unfinished append
+            lines.pop()
+        if pos > 0 and lines:
+            lines.pop(0)
+        messages = parse_chat_lines(file.name, lines)
+        if len(messages) > limit or pos == 0:
+            return messages[max(0, len(messages) - limit):], len(messages) > limit
+        # Blank or torn lines took the place of messages
+        want += limit + 1 - len(messages)
+
+def page_bounds(count: int, positions: dict, limit: int, before: Optional[int]):
+    end = count
+    if before is not None:
+        end = positions.get(before)
+        if end is None:
+            raise HTTPException(status_code=400, detail="Unknown cursor")
+    return max(0, end - limit), end
+
+async def load_chat_page(email: str, member_name: str, limit: int, before: Optional[int] = None) -> dict:
+    """`limit` messages older than the `before` id (newest when omitted), oldest first"""
+    path = chat_log_path(email, member_name)
+    async with chat_lock(email, member_name):
+        if await aiofiles.os.path.exists(path):
+            async with aiofiles.open(path, 'rb') as file:
+                st = await asyncio.to_thread(os.fstat, file.fileno())
+                index = _chat_indexes.get(path)
+                if index is not None and (index.inode != st.st_ino or st.st_size < index.size):
+                    index = None
+                if index is None and before is None:
+                    messages, has_more = await read_chat_tail(file, st.st_size, limit)
+                    return {
+                        "chat": messages,
+                        "has_more": has_more,
+                        "next_cursor": message_id(messages[0]) if has_more and messages else None,
+                    }
+                if index is None:
+                    index = ChatOffsetIndex(st.st_ino)
+                remember_chat_index(path, index)
+                if st.st_size > index.size:
+                    await index.extend(file)
+                start, end = page_bounds(len(index.ids), index.positions, limit, before)
+                messages = await index.read(file, start, end)
+            ids = index.ids
+        else:
+            chat_data = await load_chat_data_from_file(email, member_name)
+            ids = [message_id(m) for m in chat_data]
+            positions = {mid: i for i, mid in enumerate(ids) if mid is not None}
+            start, end = page_bounds(len(chat_data), positions, limit, before)
+            messages = chat_data[start:end]
+    return {
+        "chat": messages,
+        "has_more": start > 0,
+        "next_cursor": ids[start] if start > 0 else None,
+    }
+
+async def chat_etag(email: str, member_name: str) -> str:
+    # Appends grow the file and rewrites replace it, so stat alone tells
+    # whether the history changed
+    for path in (chat_log_path(email, member_name), cold_chat_path(email, member_name), legacy_chat_path(email, member_name)):
+        try:
+            st = await aiofiles.os.stat(path)
+        except FileNotFoundError:
+            continue
+        return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+    return '"empty"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
 
 #<<<<<<<<<<<<<<<<<FETCH CHAT DATA>>>>>>>>>>>>>>>>>>>>
+from fastapi import Request, Response
+
 @app.get("/medlife/fetchChat/")
-async def fetch_chat(email: str, member_name: str):
-    chat_data = load_chat_data_from_file(email, member_name)
-    return {"chat": chat_data}
+async def fetch_chat(
+    email: str,
+    member_name: str,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=CHAT_PAGE_MAX),
+    before: Optional[int] = None,
+):
+    """
+    Without `limit` the whole history is returned. With it, pages go newest
+    first: pass the returned `next_cursor` as `before` for the previous page.
+    """
+    etag = await chat_etag(email, member_name)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    if limit is None:
+        chat_data = await load_chat_data_from_file(email, member_name)
+        return {"chat": chat_data}
+    return await load_chat_page(email, member_name, limit, before)
 
 #<<<<<<<<<<<<<<<<<SAVE CHAT DATA>>>>>>>>>>>>>>>>>>>>
 from fastapi import Request
@@ -1197,6 +3685,429 @@ async def save_chat(email: str, member_name: str, request: Request):
     chat = data.get("chat", [])
     # ... process the chat data
 
-    save_chat_data_to_file(email, member_name, chat)
+    await save_chat_data_to_file(email, member_name, chat)
     return {"message": "Chat data saved successfully"}
-                                                                                                                                    
\ No newline at end of file
+
+class ChatAppendRequest(BaseModel):
+    messages: List[Dict[str, Any]]
+    after_id: Optional[int] = None
+    # The server numbers the messages after the stored history and returns
+    # the saved copies, so client clocks never decide the order
+    assign_ids: bool = False
+
+@app.post("/medlife/appendChat/")
+async def append_chat(email: str, member_name: str, body: ChatAppendRequest):
+    """
+    Delta save: send only the messages after the last saved id
+    """
+    if not body.assign_ids and any(message_id(m) is None for m in body.messages):
+        raise HTTPException(status_code=400, detail="Every message needs a numeric id")
+    return await append_chat_messages(email, member_name, body.messages, body.after_id, body.assign_ids)
+                                                                                                                                    
+
+#<<<<<<<<<<<<<<<<<CHAT SEARCH>>>>>>>>>>>>>>>>>>>>
+
+# Saved messages go into the chat_search FTS5 table as they are saved. Every
+# row carries a scope token derived from (email, member) and queries match on
+# it, so a search only walks that member's postings. Histories saved before
+# the index existed are indexed the first time they are searched.
+CHAT_SEARCH_PAGE_MAX = 50
+
+def chat_search_scope(email: str, member_name: str) -> str:
+    return hashlib.sha1(f"{email}\0{member_name}".encode()).hexdigest()[:20]
+
+def chat_search_text(message) -> str:
+    text = message.get("text") if isinstance(message, dict) else None
+    if not isinstance(text, str):
+        return ""
+    return re.sub(r"<br\s*/?>", " ", text)
+
+def chat_indexed(conn, email: str, member_name: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM chat_search_state WHERE email = ? AND member_name = ?",
+        (email, member_name)
+    ).fetchone() is not None
+
+def index_chat_messages(email: str, member_name: str, messages: list, replace: bool = False):
+    """Index saved messages; `replace` re-indexes the member's whole history.
+    Appends to a history that was never indexed are left to the first search."""
+    if not CHAT_SEARCH_AVAILABLE:
+        return
+    scope = chat_search_scope(email, member_name)
+    conn = get_db_connection()
+    try:
+        if replace:
+            conn.execute(
+                "DELETE FROM chat_search WHERE rowid IN (SELECT rowid FROM chat_search WHERE chat_search MATCH ?)",
+                (f'scope:"{scope}"',)
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO chat_search_state (email, member_name) VALUES (?, ?)",
+                (email, member_name)
+            )
+        elif not chat_indexed(conn, email, member_name):
+            return
+        conn.executemany(
+            """
+            INSERT INTO chat_search (text, scope, email, member_name, message_id, sender)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (chat_search_text(m), scope, email, member_name, message_id(m), m.get("sender"))
+                for m in messages if chat_search_text(m)
+            ]
+        )
+        conn.commit()
+    except sqlite3.Error as e:
+        # The file is the source of truth; a failed index write must not fail the save
+        conn.rollback()
+        logging.error(f"Failed to index chat for {email}/{member_name}: {e}")
+    finally:
+        conn.close()
+
+def fetch_chat_search_page(email: str, member_name: str, match: str, limit: int, offset: int) -> Optional[list]:
+    """Ranked rows, or None while the member's history has not been indexed"""
+    conn = get_db_connection()
+    try:
+        if not chat_indexed(conn, email, member_name):
+            return None
+        return conn.execute(
+            """
+            SELECT message_id, sender,
+                   snippet(chat_search, 0, '<mark>', '</mark>', '…', 16) AS snippet,
+                   bm25(chat_search, 1.0, 0.0) AS rank
+            FROM chat_search
+            WHERE chat_search MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+            """,
+            (match, limit + 1, offset)
+        ).fetchall()
+    finally:
+        conn.close()
+
+async def search_chat_messages(email: str, member_name: str, query: str, limit: int, offset: int) -> dict:
+    if not CHAT_SEARCH_AVAILABLE:
+        raise HTTPException(status_code=503, detail="Chat search is not available")
+    terms = re.findall(r"\w+", query.lower())
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query is empty")
+    match = 'scope:"{}" AND text:({})'.format(
+        chat_search_scope(email, member_name),
+        " AND ".join(f'"{term}"' for term in terms)
+    )
+
+    rows = await run_db(fetch_chat_search_page, email, member_name, match, limit, offset)
+    if rows is None:
+        async with chat_lock(email, member_name):
+            messages = await load_chat_data_from_file(email, member_name)
+            await run_db(index_chat_messages, email, member_name, messages, replace=True)
+        rows = await run_db(fetch_chat_search_page, email, member_name, match, limit, offset) or []
+
+    results = [
+        {"id": row["message_id"], "sender": row["sender"], "snippet": row["snippet"], "score": round(-row["rank"], 4)}
+        for row in rows[:limit]
+    ]
+    has_more = len(rows) > limit
+    return {"results": results, "has_more": has_more, "next_offset": offset + limit if has_more else None}
+
+@app.get("/medlife/searchChat/")
+async def search_chat(
+    email: str,
+    member_name: str,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=CHAT_SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0),
+):
+    """
+    Ranked full-text search over one member's saved chat
+    """
+    return await search_chat_messages(email, member_name, q, limit, offset)
+
+#<<<<<<<<<<<<<<<<<CONVERSATION CONTEXT>>>>>>>>>>>>>>>>>>>>
+
+# ask_ai carries the member's saved conversation into the prompt. Only the
+# newest CONTEXT_WINDOW_MESSAGES are read, as one page through the offset
+# index, so the cost stays flat as a history grows. Recent turns are kept
+# verbatim within CONTEXT_RECENT_SHARE of the model's context_tokens; older
+# turns in the window are summarized as the questions that were asked, which
+# needs no extra provider call.
+#
+# The history becomes part of the prompt, and so of the answer cache key: a
+# question only hits the cache again while the saved chat is unchanged. The
+# legacy GET ask_ai and ask_ai/stream therefore keep history off unless a
+# client passes with_history=true. CHAT_CONTEXT_ENABLED is the default for
+# the stored-member endpoints (POST ask_ai, batch, jobs, chat socket).
+CHAT_CONTEXT_ENABLED = os.getenv("CHAT_CONTEXT_ENABLED", "true").lower() == "true"
+CONTEXT_WINDOW_MESSAGES = int(os.getenv("CONTEXT_WINDOW_MESSAGES", "40"))
+CONTEXT_RECENT_SHARE = float(os.getenv("CONTEXT_RECENT_SHARE", "0.75"))
+CONTEXT_SUMMARY_ITEM_CHARS = 160
+DEFAULT_CONTEXT_TOKENS = 2000
+
+def context_token_budget(provider: str, model: str) -> int:
+    return get_provider_config(provider).get("context_tokens", {}).get(model, DEFAULT_CONTEXT_TOKENS)
+
+def message_plain_text(message) -> str:
+    text = message.get("text") if isinstance(message, dict) else None
+    if not isinstance(text, str):
+        return ""
+    text = re.sub(r"<br\s*/?>", "\n", text).strip()
+    # Answers are saved as the JSON string ask_ai returned, quotes included
+    if len(text) >= 2 and text[0] == '"' and text[-1] == '"':
+        try:
+            decoded = json.loads(text, strict=False)
+        except json.JSONDecodeError:
+            decoded = None
+        if isinstance(decoded, str):
+            text = decoded
+    return text.strip()
+
+def build_conversation_context(messages: list, budget_tokens: int) -> str:
+    turns = []
+    for message in messages:
+        text = message_plain_text(message)
+        if text:
+            turns.append(("User" if message.get("sender") == "user" else "Assistant", text))
+    if not turns or budget_tokens <= 0:
+        return ""
+
+    recent = []
+    remaining = int(budget_tokens * CONTEXT_RECENT_SHARE)
+    cut = len(turns)
+    for role, text in reversed(turns):
+        line = f"{role}: {text}"
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            if not recent and remaining > 0:
+                # Keep the start of an over-long latest turn rather than nothing
+                recent.append(line[:remaining * 4].rstrip() + "…")
+                remaining = 0
+                cut -= 1
+            break
+        recent.append(line)
+        remaining -= cost
+        cut -= 1
+    recent.reverse()
+
+    summary = []
+    remaining += budget_tokens - int(budget_tokens * CONTEXT_RECENT_SHARE)
+    for role, text in reversed(turns[:cut]):
+        if role != "User":
+            continue
+        if len(text) > CONTEXT_SUMMARY_ITEM_CHARS:
+            text = text[:CONTEXT_SUMMARY_ITEM_CHARS].rstrip() + "…"
+        item = f"- {text}"
+        cost = estimate_tokens(item)
+        if cost > remaining:
+            break
+        summary.append(item)
+        remaining -= cost
+    summary.reverse()
+
+    parts = []
+    if summary:
+        parts.append("Earlier in this conversation the patient asked:\n" + "\n".join(summary))
+    if recent:
+        parts.append("Recent conversation:\n" + "\n".join(recent))
+    return "\n\n".join(parts)
+
+async def conversation_context(email: Optional[str], member_name: Optional[str], provider: str, model: str, base_prompt: str) -> str:
+    if not email or not member_name:
+        return ""
+    budget = context_token_budget(provider, model) - estimate_tokens(base_prompt)
+    if budget <= 0:
+        return ""
+    try:
+        page = await load_chat_page(email, member_name, CONTEXT_WINDOW_MESSAGES)
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not load chat context for {email}/{member_name}: {e}")
+        return ""
+    return build_conversation_context(page["chat"], budget)
+
+#<<<<<<<<<<<<<<<<<CHAT WEBSOCKET>>>>>>>>>>>>>>>>>>
+
+# One socket per signed-in chat session. The first frame authenticates with
+# the JWT from /token or /signin and hands over the provider API keys, which
+# stay with the connection instead of travelling with every question:
+#   -> {"type": "auth", "token": ..., "api_keys": {provider: key}}
+#   <- {"type": "ready", "email": ...}
+# Questions carry a client-chosen correlation id and may overlap, up to
+# WS_MAX_IN_FLIGHT per socket; every reply frame echoes the id:
+#   -> {"type": "ask", "id": ..., "member_index": 1, "query": ..., "provider": "openai", "with_history": null}
+#   <- {"type": "chunk", "id": ..., "index": 0, "delta": ...}
+#   <- {"type": "done", "id": ..., "messages": [question, answer], "last_id": ...}
+#   <- {"type": "error", "id": ..., "error": ..., "status": ...}
+#   -> {"type": "cancel", "id": ...}
+#   -> {"type": "keys", "api_keys": {...}}
+# A finished exchange is appended to the member's chat log before `done` is
+# sent, so the client does not need a separate saveChat call.
+from fastapi import WebSocket, WebSocketDisconnect
+
+WS_AUTH_TIMEOUT_SECONDS = 10
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "4"))
+
+ws_stats = {"connections": 0, "open": 0, "questions": 0, "errors": 0}
+
+def chat_message(sender: str, text: str) -> dict:
+    """A chat log entry shaped like the ones the frontend saves"""
+    return {
+        "sender": sender,
+        "name": "You" if sender == "user" else "Medlife.ai",
+        "text": text.replace("\\n", "\n").replace("\n", "<br>"),
+    }
+
+class ChatSocket:
+    def __init__(self, websocket: WebSocket, email: str, api_keys: Dict[str, str]):
+        self.websocket = websocket
+        self.email = email
+        self.api_keys = api_keys
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, frame: dict):
+        async with self.send_lock:
+            await self.websocket.send_json(frame)
+
+    async def ask(self, frame: dict):
+        request_id = frame.get("id")
+        if not isinstance(request_id, (str, int)) or request_id in self.tasks:
+            await self.send({"type": "error", "id": request_id, "error": "Missing or duplicate id", "status": 400})
+        elif len(self.tasks) >= WS_MAX_IN_FLIGHT:
+            await self.send({"type": "error", "id": request_id, "error": "Too many questions in flight", "status": 429})
+        else:
+            task = asyncio.create_task(self.answer(request_id, frame))
+            self.tasks[request_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(request_id, None))
+
+    async def answer(self, request_id, frame: dict):
+        ws_stats["questions"] += 1
+        try:
+            await self.stream_answer(request_id, frame)
+        except HTTPException as e:
+            ws_stats["errors"] += 1
+            await self.send({"type": "error", "id": request_id, "error": e.detail, "status": e.status_code})
+        except (KeyError, TypeError, ValueError) as e:
+            ws_stats["errors"] += 1
+            await self.send({"type": "error", "id": request_id, "error": f"Invalid ask frame: {e}", "status": 400})
+        except Exception as e:
+            # Anything else (a chat log write, an unexpected provider error)
+            # still has to end the question, or the client waits forever
+            ws_stats["errors"] += 1
+            logging.exception(f"Chat socket question {request_id!r} for {self.email} failed")
+            try:
+                await self.send({"type": "error", "id": request_id, "error": f"Unexpected error: {e}", "status": 500})
+            except Exception:
+                pass  # the socket itself is gone
+
+    async def stream_answer(self, request_id, frame: dict):
+        query = str(frame["query"]).strip()
+        if not query:
+            raise ValueError("query is empty")
+        provider = frame.get("provider") or "openai"
+        api_key = self.api_keys.get(provider)
+        if not api_key:
+            raise HTTPException(status_code=400, detail=f"No API key for {provider} on this connection")
+        member = await fetch_stored_member(self.email, int(frame["member_index"]))
+        member_name = f"{member['firstName']}_{member['lastName']}"
+
+        config = get_provider_config(provider)
+        model = config["models"][0] if config and "models" in config else "gpt-3.5-turbo"
+        prefix = member_prompt_prefix(member)
+        prompt_text = await build_ai_prompt_with_context(query, provider, model, self.email, prefix,
+                                                         member_name, frame.get("with_history"))
+        chunks, breaker = await open_answer_stream(prompt_text, prefix, api_key, provider, model)
+
+        deltas = []
+        failed = None  # stays None if the question is cancelled mid-stream
+        try:
+            async for delta in chunks:
+                await self.send({"type": "chunk", "id": request_id, "index": len(deltas), "delta": delta})
+                deltas.append(delta)
+            failed = False
+        except (ProviderError, ValueError, httpx.HTTPError) as e:
+            failed, status = stream_failure(e)
+            logging.error(f"Streaming error from {provider}: {e}")
+            raise HTTPException(status_code=status, detail=str(e))
+        finally:
+            if failed is None:
+                breaker.release()
+            else:
+                breaker.record_result(failed=failed)
+
+        saved = await append_chat_messages(
+            self.email, member_name,
+            [chat_message("user", query), chat_message("ai", "".join(deltas))],
+            assign_ids=True
+        )
+        await self.send({"type": "done", "id": request_id, "messages": saved["messages"], "last_id": saved["last_id"]})
+
+    def cancel_all(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+def parse_socket_api_keys(value) -> Optional[Dict[str, str]]:
+    """The api_keys of an auth or keys frame; None unless it maps names to strings"""
+    if value is None:
+        return {}
+    if not isinstance(value, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in value.items()):
+        return None
+    return value
+
+async def authenticate_chat_socket(websocket: WebSocket) -> Optional[ChatSocket]:
+    try:
+        frame = await asyncio.wait_for(websocket.receive_json(), WS_AUTH_TIMEOUT_SECONDS)
+        if frame.get("type") != "auth":
+            raise JWTError("expected an auth frame")
+        email = jwt.decode(frame.get("token") or "", SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+        if email is None:
+            raise JWTError("token has no subject")
+    except (asyncio.TimeoutError, JWTError, ValueError, AttributeError):
+        await websocket.close(code=1008, reason="Could not validate credentials")
+        return None
+    api_keys = parse_socket_api_keys(frame.get("api_keys"))
+    if api_keys is None:
+        await websocket.send_json({"type": "error", "id": None, "error": "api_keys must map providers to keys", "status": 400})
+        await websocket.close(code=1008, reason="Invalid api_keys")
+        return None
+    return ChatSocket(websocket, email, dict(api_keys))
+
+@app.websocket("/medlife/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    await websocket.accept()
+    session = await authenticate_chat_socket(websocket)
+    if session is None:
+        return
+    ws_stats["connections"] += 1
+    ws_stats["open"] += 1
+    try:
+        await session.send({"type": "ready", "email": session.email})
+        while True:
+            try:
+                frame = await websocket.receive_json()
+            except ValueError:
+                await session.send({"type": "error", "id": None, "error": "Frames must be JSON", "status": 400})
+                continue
+            kind = frame.get("type") if isinstance(frame, dict) else None
+            if kind == "ask":
+                await session.ask(frame)
+            elif kind == "cancel":
+                task = session.tasks.get(frame.get("id"))
+                if task is not None:
+                    task.cancel()
+            elif kind == "keys":
+                api_keys = parse_socket_api_keys(frame.get("api_keys"))
+                if api_keys is None:
+                    await session.send({"type": "error", "id": None, "error": "api_keys must map providers to keys", "status": 400})
+                else:
+                    session.api_keys.update(api_keys)
+            else:
+                await session.send({"type": "error", "id": None, "error": f"Unknown frame type: {kind}", "status": 400})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        session.cancel_all()
+        ws_stats["open"] -= 1
+
+@app.get("/medlife/metrics/websocket")
+async def websocket_metrics():
+    return ws_stats
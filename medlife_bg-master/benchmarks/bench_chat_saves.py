@@ -0,0 +1,67 @@
+"""
+Concurrent chat saves: many appendChat calls spread over a few members, then
+racing full saveChat calls on one member. Checks that no appended message is
+lost, that the racing saves leave one complete history, and that no temp
+files are left behind.
+
+    python benchmarks/bench_chat_saves.py --appends 200 --members 10
+"""
+import argparse
+import asyncio
+import glob
+import os
+import time
+
+import httpx
+
+from common import load_app, summary, timed
+
+EMAIL = "saves@example.com"
+
+def message(i: int, sender: str = "user") -> dict:
+    return {"id": i, "sender": sender, "name": "You", "text": f"message {i}"}
+
+async def main(args):
+    app = load_app()
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        async def append(i):
+            member = f"Member{i % args.members}_Bench"
+            # Each member's ids only grow, so none of these can be dropped as stale
+            return await timed(client.post(
+                "/medlife/appendChat/", params={"email": EMAIL, "member_name": member},
+                json={"messages": [message(1000 + i)]},
+            ))
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[append(i) for i in range(args.appends)])
+        elapsed = time.perf_counter() - started
+        errors = sum(1 for response, _ in results if response.status_code != 200)
+        print(f"appends: {summary([ms for _, ms in results])} errors={errors} in {elapsed:.2f}s")
+
+        stored = 0
+        for m in range(args.members):
+            response = await client.get("/medlife/fetchChat/", params={"email": EMAIL, "member_name": f"Member{m}_Bench"})
+            stored += len(response.json()["chat"])
+        print(f"stored {stored} of {args.appends} appended messages")
+
+        histories = [[message(j) for j in range(1, 20 + i)] for i in range(args.saves)]
+        started = time.perf_counter()
+        results = await asyncio.gather(*[
+            timed(client.post("/medlife/saveChat/", params={"email": EMAIL, "member_name": "Race_Bench"}, json={"chat": history}))
+            for history in histories
+        ])
+        elapsed = time.perf_counter() - started
+        print(f"full saves: {summary([ms for _, ms in results])} in {elapsed:.2f}s")
+        chat = (await client.get("/medlife/fetchChat/", params={"email": EMAIL, "member_name": "Race_Bench"})).json()["chat"]
+        ids = [m["id"] for m in chat]
+        consistent = ids == list(range(1, len(ids) + 1)) and any(len(h) == len(ids) for h in histories)
+        print(f"racing saves left {len(ids)} messages, consistent={consistent}")
+        print(f"stray temp files: {len(glob.glob(os.path.join(app.CHAT_DATA_DIR, '**', '*.tmp'), recursive=True))}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--appends", type=int, default=200)
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--saves", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,62 @@
+"""
+Login burst vs chat latency: fires --logins concurrent POST /token calls while
+fetchChat is called back to back, and reports chat latency idle and during
+the burst. bcrypt runs on its own executor, so chat latency should stay in
+the same range instead of stalling behind every hash.
+
+    python benchmarks/bench_login_burst.py --logins 30 --rounds 10
+
+passlib 1.7.4 fails on bcrypt>=4.1 ("password cannot be longer than 72
+bytes"); run with bcrypt<4.1 installed.
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from common import load_app, summary, timed
+
+EMAIL = "burst@example.com"
+PASSWORD = "Burst-Pass1!"
+
+async def main(args):
+    app = load_app(BCRYPT_ROUNDS=str(args.rounds))
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        response = await client.post("/signup", json={"username": "burst", "email": EMAIL, "password": PASSWORD})
+        response.raise_for_status()
+        await client.post("/medlife/appendChat/", params={"email": EMAIL, "member_name": "Chat_Bench"}, json={
+            "messages": [{"id": i, "sender": "user", "name": "You", "text": f"message {i}"} for i in range(1, 41)]
+        })
+
+        async def chat_latencies(count):
+            latencies = []
+            for _ in range(count):
+                _, ms = await timed(client.get("/medlife/fetchChat/", params={
+                    "email": EMAIL, "member_name": "Chat_Bench", "limit": 20,
+                }))
+                latencies.append(ms)
+                await asyncio.sleep(0.01)
+            return latencies
+
+        idle = await chat_latencies(args.chat_requests)
+        started = time.perf_counter()
+        logins = asyncio.gather(*[
+            client.post("/token", data={"username": EMAIL, "password": PASSWORD}) for _ in range(args.logins)
+        ])
+        busy = await chat_latencies(args.chat_requests)
+        responses = await logins
+        elapsed = time.perf_counter() - started
+
+    ok = sum(1 for r in responses if r.status_code == 200)
+    print(f"logins: {ok}/{args.logins} ok, {args.logins / elapsed:.1f} logins/s at {args.rounds} rounds")
+    print(f"chat idle:        {summary(idle)}")
+    print(f"chat during burst: {summary(busy)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--logins", type=int, default=30)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--chat-requests", type=int, default=30)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,49 @@
+"""
+Shared setup for the benchmark scripts: a fresh copy of app.py running in a
+temp directory, driven in-process through httpx's ASGI transport.
+"""
+import importlib
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEMBER = {
+    "firstName": "Bench", "lastName": "Mark", "dob": "2000-01-01", "race": "n/a", "gender": "F",
+    "height": "5ft", "weight": "60kg", "a1c": "5", "bloodPressure": "120/80", "medicine": "none",
+    "tokens": 0,
+}
+
+def load_app(**env):
+    """Import app.py inside a new temp directory so it builds its own users.db;
+    chat files go to a chat_data directory there too"""
+    workdir = tempfile.mkdtemp(prefix="medlife-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("CHAT_TIERING_ENABLED", "false")
+    os.environ.setdefault("JOB_WORKERS", "0")
+    os.environ.update(env)
+    sys.path.insert(0, BACKEND_DIR)
+    app = importlib.import_module("app")
+    app.CHAT_DATA_DIR = os.path.join(workdir, "chat_data")
+    os.makedirs(app.CHAT_DATA_DIR)
+    return app
+
+def mock_provider(app, host: str, handler):
+    """Route a provider host to an httpx MockTransport handler"""
+    import httpx
+    app._provider_http_clients[host] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+async def timed(coro):
+    started = time.perf_counter()
+    result = await coro
+    return result, (time.perf_counter() - started) * 1000
+
+def summary(latencies_ms) -> str:
+    if not latencies_ms:
+        return "n=0"
+    ordered = sorted(latencies_ms)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return f"n={len(ordered)} p50={statistics.median(ordered):.1f}ms p95={p95:.1f}ms max={ordered[-1]:.1f}ms"
@@ -0,0 +1,65 @@
+"""
+Mixed load: database endpoints and ask_ai calls at the same time, with the AI
+provider mocked to answer after --ai-latency seconds. With blocking database
+work off the event loop, DB latency should stay flat while AI calls wait.
+
+    python benchmarks/load_mixed.py --db-requests 400 --ai-requests 100
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from common import MEMBER, load_app, mock_provider, summary, timed
+
+async def main(args):
+    # Lift the per-key provider rate limit; this measures the server, not the quota
+    app = load_app(MISTRAL_RPM="100000", MISTRAL_TPM="1000000000")
+
+    async def mistral(request):
+        await asyncio.sleep(args.ai_latency)
+        question = json.loads(request.content)["messages"][-1]["content"]
+        return httpx.Response(200, json={"choices": [{"message": {"content": f"answer to {question[-20:]}"}}]})
+    mock_provider(app, "api.mistral.ai", mistral)
+
+    email = "load@example.com"
+    transport = httpx.ASGITransport(app=app.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        await client.post("/medlife/addmember", json={**MEMBER, "email": email})
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def db_call(i):
+            async with semaphore:
+                if i % 2:
+                    return await timed(client.get("/medlife/getmember", params={"email": email}))
+                return await timed(client.get(f"/api/member-details/{email}/1"))
+
+        async def ai_call(i):
+            async with semaphore:
+                return await timed(client.post("/medlife/ask_ai/", json={
+                    "email": email, "member_index": 1, "query": f"question {i}",
+                    "api_key": "bench", "provider": "mistral", "with_history": False,
+                }))
+
+        started = time.perf_counter()
+        db_results, ai_results = await asyncio.gather(
+            asyncio.gather(*[db_call(i) for i in range(args.db_requests)]),
+            asyncio.gather(*[ai_call(i) for i in range(args.ai_requests)]),
+        )
+        elapsed = time.perf_counter() - started
+
+    for label, results in (("db", db_results), ("ai", ai_results)):
+        errors = sum(1 for response, _ in results if response.status_code != 200)
+        print(f"{label}: {summary([ms for _, ms in results])} errors={errors}")
+    total = args.db_requests + args.ai_requests
+    print(f"total {total} requests in {elapsed:.2f}s ({total / elapsed:.0f} req/s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db-requests", type=int, default=400)
+    parser.add_argument("--ai-requests", type=int, default=100)
+    parser.add_argument("--ai-latency", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,29 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+@pytest.fixture
+def load_app(tmp_path, monkeypatch):
+    """
+    Import a fresh copy of app.py inside an empty temp directory, so it builds
+    its own users.db there, and point its chat files at tmp_path/chat_data.
+    Settings are read at import time, so pass them as environment overrides.
+    """
+    def load(**env):
+        monkeypatch.chdir(tmp_path)
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.setenv("CHAT_TIERING_ENABLED", "false")
+        monkeypatch.setenv("JOB_WORKERS", "0")
+        sys.modules.pop("app", None)
+        app = importlib.import_module("app")
+        app.CHAT_DATA_DIR = str(tmp_path / "chat_data")
+        os.makedirs(app.CHAT_DATA_DIR)
+        return app
+    yield load
+    sys.modules.pop("app", None)
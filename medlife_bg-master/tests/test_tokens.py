@@ -0,0 +1,42 @@
+import asyncio
+
+import httpx
+import pytest
+
+EMAIL = "stress@example.com"
+MEMBER = {
+    "firstName": "Stress", "lastName": "Test", "dob": "2000-01-01", "race": "n/a", "gender": "F",
+    "height": "5ft", "weight": "60kg", "a1c": "5", "bloodPressure": "120/80", "medicine": "none",
+    "tokens": 0, "email": EMAIL,
+}
+CALLS = 150
+
+@pytest.mark.parametrize("mode", ["sqlite", "memory"])
+def test_concurrent_increments_stop_exactly_at_limit(load_app, mode):
+    app = load_app(TOKEN_COUNTER_MODE=mode)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post("/medlife/addmember", json=MEMBER)
+            assert response.status_code == 200
+            return await asyncio.gather(*[
+                client.get("/medlife/tokens/", params={"email": EMAIL, "member_name": "Stress"})
+                for _ in range(CALLS)
+            ])
+
+    responses = asyncio.run(run())
+    ok = [r for r in responses if r.status_code == 200]
+    rejected = [r for r in responses if r.status_code == 400]
+    assert len(ok) == app.QUESTION_LIMIT
+    assert len(rejected) == CALLS - app.QUESTION_LIMIT
+    assert sorted(int(r.json()["message"]) for r in ok) == list(range(1, app.QUESTION_LIMIT + 1))
+
+    if mode == "memory":
+        app.flush_token_counters()
+    conn = app.get_db_connection()
+    try:
+        stored = conn.execute("SELECT tokens FROM members WHERE email = ?", (EMAIL,)).fetchone()[0]
+    finally:
+        conn.close()
+    assert stored == app.QUESTION_LIMIT